@@ -1,19 +1,30 @@
 from fastapi import APIRouter, HTTPException, Depends, status
-from passlib.context import CryptContext
 from librarytools import UserTable, RTT
+from passwords import verify_password, get_password_hash, verify_password_async, get_password_hash_async
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from datetime import timedelta, datetime, timezone
-from jose import JWTError, jwt
+from collections import OrderedDict
+import asyncio
+import logging
+import os
+import threading
+import time
 import uuid
 from fastapi import Request
+from typing import Dict, List
 
 SECRET_KEY = "TESTKEY" # FIX LATER
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 1
+# Number of verified access tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+# How often expired and revoked refresh tokens are purged, in seconds
+REFRESH_TOKEN_PURGE_INTERVAL = int(os.environ.get("REFRESH_TOKEN_PURGE_INTERVAL", 3600))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger("bookshelf.auth")
 
 router = APIRouter()
 
@@ -41,33 +52,126 @@ class CurrentUser(BaseModel):
     username: str
 
 
-# Utility Functions
-def verify_password(plain: str, hash: str):
-    if not isinstance(plain, str):
-        plain = str(plain)
-    return pwd_context.verify(plain[:72], hash)
+class TokenCache:
+    '''
+    Bounded LRU cache from a verified access token to its CurrentUser.
+    Entries expire at the token's own "exp", so a cached token is never
+    accepted for longer than decoding it would have been.
+    '''
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> CurrentUser | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                user, expires_at = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return user
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, user: CurrentUser, expires_at: float):
+        with self._lock:
+            self._entries[token] = (user, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+tokenCache = TokenCache()
+
+class RevocationSet:
+    '''
+    In-memory set of revoked refresh token ids, so /refresh can reject a
+    revoked token without reading SQLite. Entries are dropped once the
+    token would have expired anyway. A refresh that gets past the set still
+    writes once, rotating the token in SQLite: that write is what stops a
+    token revoked or already rotated by another worker process, so it is
+    not deferred.
+    '''
+    def __init__(self):
+        self._revoked: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, jti: str, expires_at: int):
+        with self._lock:
+            self._revoked[jti] = expires_at
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def load(self, tokens: List[tuple]):
+        with self._lock:
+            self._revoked = {jti: expires_at for jti, expires_at in tokens}
 
-def get_password_hash(password: str):
-    if not isinstance(password, str):
-        password = str(password)
-    return pwd_context.hash(password[:72])
+    def prune(self):
+        now = int(time.time())
+        with self._lock:
+            self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
 
+revokedTokens = RevocationSet()
+
+def start_token_maintenance():
+    revokedTokens.load(refreshTokenTable.revoked_tokens())
+
+async def purge_refresh_tokens_periodically(interval: int = REFRESH_TOKEN_PURGE_INTERVAL):
+    '''
+    Background task: deletes expired and revoked refresh tokens every interval.
+    '''
+    while True:
+        try:
+            deleted = await asyncio.to_thread(refreshTokenTable.purge_tokens)
+            revokedTokens.prune()
+            logger.info("Purged refresh tokens", extra={"deleted": deleted})
+        except Exception:
+            logger.exception("Refresh token purge failed")
+        await asyncio.sleep(interval)
+
+
+# Utility Functions
+# python-jose (and its crypto backend) is imported on first use rather than
+# at startup; after that the import is just a lookup in sys.modules
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_refresh_token(data: dict):
+def create_refresh_token(data: dict, rotates: str | None = None):
+    '''
+    Issues a refresh token. With rotates, the token with that jti is
+    revoked in the same transaction that stores the new one, and a token
+    that was already revoked gets a 401 instead of a replacement.
+    '''
     jti = str(uuid.uuid4())
     to_encode = data.copy()
     if not data.get("username"):
         raise HTTPException(status_code=401, detail="Error: Invalid refresh token")
     expire = datetime.now(timezone.utc) + timedelta(minutes=REFRESH_TOKEN_EXPIRE_DAYS)
     to_encode.update({"jti": jti, "exp": expire, "scope": "refresh_token"})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    refreshTokenTable.store_refresh_token(jti=jti, username=data.get("username"), expires_at=int(expire.timestamp()))
+    if rotates is None:
+        refreshTokenTable.store_refresh_token(jti=jti, username=data.get("username"), expires_at=int(expire.timestamp()))
+    elif not refreshTokenTable.rotate_refresh_token(rotates, jti, data.get("username"), int(expire.timestamp())):
+        raise HTTPException(status_code=401, detail="Refresh token has been revoked.")
     return encoded_jwt
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -82,6 +186,7 @@ def verify_refresh_token(token: str) -> dict:
         detail="Could not validate credentials.",
         headers={"WWW-Authenticate": "Bearer"}
     )
+    from jose import JWTError, jwt
 
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -92,58 +197,64 @@ def verify_refresh_token(token: str) -> dict:
         raise credentials_exception
     
 async def get_current_userID(token: str = Depends(oauth2_scheme)) -> CurrentUser:
-    print(f"Received token: {token}")  # 👈 TEMP DEBUG
+    user = tokenCache.get(token)
+    if user is not None:
+        return user
+
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    from jose import JWTError, jwt
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print(f"Decoded payload: {payload}")  # 👈 TEMP DEBUG
         user_id: str = payload.get("sub")
         username: str = payload.get("username")
         
         if user_id is None:
             raise credentials_exception
         user = CurrentUser(user_id=int(user_id), username=username)
+        tokenCache.put(token, user, payload.get("exp", 0))
+        logger.debug("Verified access token", extra={"user_id": user.user_id})
         return user
-    except JWTError:
+    except JWTError as e:
+        logger.debug("Rejected access token: %s", e)
         raise credentials_exception
 
 
  
 # Routes
 @router.post("/register")
-def register_user(user: UserRegister):
+async def register_user(user: UserRegister):
     username = user.username
     password = user.password
     # check if the username already exists
-    if userTable.usernameCheck(username):
+    if await run_in_threadpool(userTable.usernameCheck, username):
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed_pw = get_password_hash(password)
+    hashed_pw = await get_password_hash_async(password)
     try:
-        userTable.addUser(username, hashed_pw)
+        await run_in_threadpool(userTable.addUser, username, hashed_pw)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Error adding user to users table.")
     
     return {"message": "User created successfully"}
 
 @router.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = userTable.usernameCheck(form_data.username) 
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await run_in_threadpool(userTable.usernameCheck, form_data.username)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid username or password.")        
 
     id, username, hashed_pw = user
     id = str(id)
 
-    if not verify_password(form_data.password, hashed_pw):
+    if not await verify_password_async(form_data.password, hashed_pw):
         raise HTTPException(status_code=400, detail="Invalid username or password.")
     
     access_token = create_access_token({"sub": id, "username": username})
-    refresh_token = create_refresh_token({"sub": id, "username": username})
+    refresh_token = await run_in_threadpool(create_refresh_token, {"sub": id, "username": username})
 
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
@@ -157,12 +268,14 @@ def refresh(refresh_info: RefreshRequest):
     jti = payload.get('jti')
     
     if not jti or not user_id:
-        return HTTPException(status_code=401, detail="Invalid refresh token.")
-    
-    refreshTokenTable.revoke_refresh_token(jti=jti)
+        raise HTTPException(status_code=401, detail="Invalid refresh token.")
+    if jti in revokedTokens:
+        raise HTTPException(status_code=401, detail="Refresh token has been revoked.")
 
+    # Rotate the token; if it was already revoked (or purged) elsewhere, refuse
+    new_refresh_token = create_refresh_token({"sub": user_id, "username": username}, rotates=jti)
+    revokedTokens.add(jti, payload.get("exp", 0))
     new_access_token = create_access_token({"sub": user_id, "username": username})
-    new_refresh_token = create_refresh_token({"sub": user_id, "username": username})
 
     return {"access_token": new_access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
 
@@ -176,4 +289,15 @@ def logout(logout_info: LogoutRequest):
     jti = payload.get("jti")
     if jti:
         refreshTokenTable.revoke_refresh_token(jti=jti)
-    return {"message": "Logged Out2"}
\ No newline at end of file
+        revokedTokens.add(jti, payload.get("exp", 0))
+    return {"message": "Logged Out2"}
+
+@router.post("/logout-all")
+def logout_all(current_user: CurrentUser = Depends(get_current_userID)):
+    '''
+    Revoke every refresh token of the current user ("log out everywhere").
+    '''
+    revoked = refreshTokenTable.revoke_user_tokens(current_user.username)
+    for jti, expires_at in revoked:
+        revokedTokens.add(jti, expires_at)
+    return {"message": f"Logged out of {len(revoked)} session(s)."}
@@ -0,0 +1,459 @@
+from typing import Dict, Iterator, List, Tuple
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from fastapi import HTTPException
+import librarytools
+import jobs
+from database import Database, db
+
+# Bulk import of a directory or zip archive of books. Entries are hashed and
+# type-checked in parallel worker processes, then registered in batches of
+# IMPORT_BATCH_SIZE per transaction. Every entry is recorded in import_items,
+# so an interrupted import picks up where it stopped.
+
+# Number of hashing processes; defaults to one per core. In the server they
+# are one pool shared by every import.
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", os.cpu_count() or 1))
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 200))
+# Imports the server runs at once, and how many more may wait their turn
+# before /import answers 429
+IMPORT_MAX_RUNNING = int(os.environ.get("IMPORT_MAX_RUNNING", 2))
+IMPORT_QUEUE_LIMIT = int(os.environ.get("IMPORT_QUEUE_LIMIT", 8))
+# Largest archive accepted, and largest total it may unpack to. Each entry
+# is also held to librarytools.UPLOAD_MAX_SIZE, like a single upload.
+IMPORT_MAX_SIZE = int(os.environ.get("IMPORT_MAX_SIZE", 16 * 1024 * 1024 * 1024))
+# An import is worked on by one process at a time, the holder of its lease.
+# A lease not renewed for this long is free for another process to take.
+IMPORT_LEASE_SECONDS = int(os.environ.get("IMPORT_LEASE_SECONDS", 60))
+
+# Archives uploaded through the /import endpoint are kept here until imported
+IMPORT_DIRECTORY = os.path.abspath('./imports')
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+PENDING = "pending"
+# Stopped with Ctrl-C in scripts/bulk_import.py; only --resume picks it up again
+INTERRUPTED = "interrupted"
+
+logger = logging.getLogger("bookshelf.import")
+
+
+class ImportInUse(Exception):
+    '''
+    Raised when another process holds an import's lease.
+    '''
+
+
+class ImportTable:
+    def __init__(self, database: Database = db):
+        self.database = database
+
+    def add_import(self, user_id: int, source: str) -> str:
+        import_id = str(uuid.uuid4())
+        now = int(time.time())
+        with self.database.transaction() as con:
+            con.execute(
+                "INSERT INTO imports (id, user_id, source, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (import_id, user_id, source, RUNNING, now, now)
+            )
+        return import_id
+
+    def get_import(self, import_id: str) -> Dict | None:
+        keys = ['id', 'user_id', 'source', 'status', 'created_at', 'updated_at']
+        row = self.database.connection().execute(
+            "SELECT id, user_id, source, status, created_at, updated_at FROM imports WHERE id = ?", (import_id,)
+        ).fetchone()
+        return dict(zip(keys, row)) if row else None
+
+    def set_status(self, import_id: str, status: str):
+        with self.database.transaction() as con:
+            con.execute(
+                "UPDATE imports SET status = ?, updated_at = ? WHERE id = ?",
+                (status, int(time.time()), import_id)
+            )
+
+    def running_imports(self) -> List[str]:
+        '''
+        Running imports no process holds a live lease on.
+        '''
+        cursor = self.database.connection().execute(
+            "SELECT id FROM imports WHERE status = ? AND (owner IS NULL OR heartbeat_at < ?) ORDER BY created_at",
+            (RUNNING, int(time.time()) - IMPORT_LEASE_SECONDS)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def claim(self, import_id: str, owner: str) -> bool:
+        '''
+        Takes the lease on an import and marks it running, unless another
+        process holds a live lease. Returns whether owner now holds it.
+        '''
+        now = int(time.time())
+        with self.database.transaction() as con:
+            cursor = con.execute("""
+                UPDATE imports SET owner = ?, heartbeat_at = ?, status = ?, updated_at = ?
+                WHERE id = ? AND (owner IS NULL OR owner = ? OR heartbeat_at < ?)
+            """, (owner, now, RUNNING, now, import_id, owner, now - IMPORT_LEASE_SECONDS))
+            return cursor.rowcount > 0
+
+    def renew(self, import_id: str, owner: str, con=None) -> bool:
+        '''
+        Renews owner's lease, in con's transaction if given. Returns False
+        if the lease was lost.
+        '''
+        now = int(time.time())
+        with self.database.transaction() if con is None else nullcontext(con) as con:
+            cursor = con.execute(
+                "UPDATE imports SET heartbeat_at = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                (now, now, import_id, owner)
+            )
+            return cursor.rowcount > 0
+
+    def release(self, import_id: str, owner: str, status: str | None = None):
+        '''
+        Gives up owner's lease, setting the import's status if given.
+        '''
+        with self.database.transaction() as con:
+            con.execute("""
+                UPDATE imports SET owner = NULL, heartbeat_at = NULL, status = COALESCE(?, status), updated_at = ?
+                WHERE id = ? AND owner = ?
+            """, (status, int(time.time()), import_id, owner))
+
+    def add_items(self, import_id: str, entries: List[str]):
+        # Already-listed entries keep their status, so re-listing on resume is safe
+        with self.database.transaction() as con:
+            con.executemany(
+                "INSERT OR IGNORE INTO import_items (import_id, entry) VALUES (?, ?)",
+                [(import_id, entry) for entry in entries]
+            )
+
+    def pending_items(self, import_id: str) -> List[str]:
+        cursor = self.database.connection().execute(
+            "SELECT entry FROM import_items WHERE import_id = ? AND status = ? ORDER BY entry",
+            (import_id, PENDING)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def counts(self, import_id: str) -> Dict[str, int]:
+        cursor = self.database.connection().execute(
+            "SELECT status, COUNT(*) FROM import_items WHERE import_id = ? GROUP BY status", (import_id,)
+        )
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(cursor.fetchall()))
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def failed_items(self, import_id: str, limit: int = 100) -> List[Dict]:
+        cursor = self.database.connection().execute(
+            "SELECT entry, error FROM import_items WHERE import_id = ? AND status = ? ORDER BY entry LIMIT ?",
+            (import_id, FAILED, limit)
+        )
+        return [{"entry": entry, "error": error} for entry, error in cursor.fetchall()]
+
+
+importTable = ImportTable()
+
+
+def _skip_entry(entry: str) -> bool:
+    # Hidden files and the resource forks macOS adds to zip archives
+    parts = entry.replace(os.sep, '/').split('/')
+    return any(part.startswith('.') or part == '__MACOSX' for part in parts)
+
+def archive_size(source: str) -> int:
+    '''
+    The total uncompressed size of a zip archive's entries. Reading an entry
+    never yields more than its recorded size, so this bounds what an import
+    can write.
+    '''
+    with zipfile.ZipFile(source) as archive:
+        return sum(info.file_size for info in archive.infolist() if not info.is_dir())
+
+def list_entries(source: str) -> Iterator[str]:
+    '''
+    Yields the files to import: paths relative to a directory, or member
+    names of a zip archive.
+    '''
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                entry = os.path.relpath(os.path.join(root, name), source)
+                if not _skip_entry(entry):
+                    yield entry
+    else:
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and not _skip_entry(info.filename):
+                    yield info.filename
+
+
+# Zip archives opened by this worker process, reused across entries
+_archives: Dict[str, zipfile.ZipFile] = {}
+
+def hash_entry(source: str, entry: str) -> Tuple[str, str | None, str | None, str | None, str | None]:
+    '''
+    Entry point inside the worker process. Streams one entry into a temp
+    file in ./books, checking its type and hashing it on the way.
+    Returns (entry, temp location, extension, content hash, error).
+    '''
+    try:
+        if os.path.isdir(source):
+            stream = open(os.path.join(source, entry), 'rb')
+        else:
+            if source not in _archives:
+                # The pool outlives any one import, so only the newest few archives stay open
+                while len(_archives) >= 4:
+                    _archives.pop(next(iter(_archives))).close()
+                _archives[source] = zipfile.ZipFile(source)
+            stream = _archives[source].open(entry)
+        with stream:
+            temp_location, file_extension, content_hash = librarytools.store_book_stream(stream)
+        return entry, temp_location, file_extension, content_hash, None
+    except HTTPException as e:
+        return entry, None, None, None, e.detail
+    except Exception as e:
+        return entry, None, None, None, str(e)
+
+
+def _commit_batch(import_id: str, owner: str, user_id: int, results: List[Tuple]) -> List[Tuple[str, str, str]]:
+    '''
+    Registers a batch of hashed entries in one transaction. Each book runs
+    in its own savepoint so one bad entry doesn't undo the rest. Entries
+    are only registered while they are still pending and owner still holds
+    the import's lease, so an entry never becomes two books. Returns the
+    background jobs to submit for the new books.
+    '''
+    newJobs = []
+    try:
+        with db.transaction() as con:
+            if not importTable.renew(import_id, owner, con):
+                raise ImportInUse(import_id)
+            for entry, temp_location, file_extension, content_hash, error in results:
+                bookData = {
+                    "id": librarytools.generate_unique_id(),
+                    "title": os.path.basename(entry),
+                    "author": None,
+                    "file_type": file_extension,
+                    "user_id": user_id,
+                    "content_hash": content_hash
+                }
+                claimed = con.execute(
+                    "UPDATE import_items SET status = ?, book_id = ?, error = ? WHERE import_id = ? AND entry = ? AND status = ?",
+                    (FAILED if error else DONE, None if error else bookData["id"], error, import_id, entry, PENDING)
+                ).rowcount
+                if not claimed:
+                    if temp_location and os.path.exists(temp_location):
+                        os.remove(temp_location)
+                    continue
+                if error is not None:
+                    continue
+                try:
+                    isNewBlob = librarytools.store_book_blob(bookData, temp_location)
+                except Exception as e:
+                    con.execute(
+                        "UPDATE import_items SET status = ?, book_id = NULL, error = ? WHERE import_id = ? AND entry = ?",
+                        (FAILED, str(e), import_id, entry)
+                    )
+                    continue
+                file_location = librarytools.blob_location(content_hash, file_extension)
+                newJobs.append((bookData["id"], "metadata", file_location))
+                if isNewBlob:
+                    newJobs.append((bookData["id"], "thumbnail", file_location))
+                    newJobs.append((bookData["id"], "text", file_location))
+    except BaseException:
+        # Files are only moved into place after a commit
+        for entry, temp_location, *_ in results:
+            if temp_location and os.path.exists(temp_location):
+                os.remove(temp_location)
+        raise
+    return newJobs
+
+_stopping = threading.Event()
+# The server's shared hashing pool and the threads that run imports
+_pool: ProcessPoolExecutor | None = None
+_runner: ThreadPoolExecutor | None = None
+_workers = IMPORT_WORKERS
+# Imports running or waiting for a runner thread
+_active = 0
+_activeLock = threading.Lock()
+
+def run_import(import_id: str, workers: int = IMPORT_WORKERS, progress=None, pool: ProcessPoolExecutor | None = None) -> Dict:
+    '''
+    Runs (or resumes) an import until every entry is registered or failed,
+    holding its lease throughout. Entries are hashed in pool, or in a pool
+    of workers processes of its own if none is given. progress, if given,
+    is called with the counts after each batch. Returns the final progress
+    report. Raises ImportInUse if another process holds or takes the lease.
+    '''
+    record = importTable.get_import(import_id)
+    if record is None:
+        raise ValueError(f"Unknown import: {import_id}")
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not importTable.claim(import_id, owner):
+        raise ImportInUse(import_id)
+
+    status = None
+    try:
+        status = _run_claimed(import_id, owner, record["source"], record["user_id"], workers, progress, pool)
+    except KeyboardInterrupt:
+        status = INTERRUPTED
+        raise
+    finally:
+        importTable.release(import_id, owner, status)
+    return import_progress(import_id)
+
+def _run_claimed(import_id: str, owner: str, source: str, user_id: int, workers: int, progress, pool) -> str | None:
+    '''
+    The body of run_import. Returns the status to leave the import in, or
+    None to leave it running for the next start.
+    '''
+    try:
+        if not os.path.isdir(source) and archive_size(source) > IMPORT_MAX_SIZE:
+            logger.error("Import %s unpacks to more than %d bytes", import_id, IMPORT_MAX_SIZE)
+            return FAILED
+        batch = []
+        for entry in list_entries(source):
+            batch.append(entry)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                importTable.add_items(import_id, batch)
+                batch = []
+        importTable.add_items(import_id, batch)
+    except (OSError, zipfile.BadZipFile) as e:
+        logger.error("Import %s could not read %s: %s", import_id, source, e)
+        return FAILED
+
+    entries = iter(importTable.pending_items(import_id))
+    window = max(1, workers) * 4
+    heartbeat = IMPORT_LEASE_SECONDS / 4
+    renewedAt = time.monotonic()
+    ownPool = pool is None
+    if ownPool:
+        pool = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn"))
+    inFlight = set()
+    results = []
+    try:
+        while not _stopping.is_set():
+            # Keep a bounded number of entries queued so memory use stays flat
+            for entry in entries:
+                inFlight.add(pool.submit(hash_entry, source, entry))
+                if len(inFlight) >= window:
+                    break
+            if not inFlight:
+                break
+            finished, inFlight = wait(inFlight, timeout=heartbeat, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in finished)
+            if len(results) >= IMPORT_BATCH_SIZE or (results and not inFlight):
+                jobs.submit_many(_commit_batch(import_id, owner, user_id, results))
+                results = []
+                renewedAt = time.monotonic()
+                if progress is not None:
+                    progress(importTable.counts(import_id))
+            elif time.monotonic() - renewedAt >= heartbeat:
+                if not importTable.renew(import_id, owner):
+                    raise ImportInUse(import_id)
+                renewedAt = time.monotonic()
+    finally:
+        # Entries hashed but not registered are thrown away and hashed again on resume
+        for future in inFlight:
+            future.cancel()
+        if ownPool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for future in wait(inFlight).done:
+            if not future.cancelled() and future.exception() is None:
+                results.append(future.result())
+        for entry, temp_location, *_ in results:
+            if temp_location and os.path.exists(temp_location):
+                os.remove(temp_location)
+
+    return None if _stopping.is_set() else DONE
+
+
+def import_progress(import_id: str) -> Dict | None:
+    record = importTable.get_import(import_id)
+    if record is None:
+        return None
+    record.update(importTable.counts(import_id))
+    record["failures"] = importTable.failed_items(import_id)
+    return record
+
+
+def start_import(import_id: str, cleanup: bool = False, queue: bool = True) -> Future:
+    '''
+    Queues an import to run in the background, at most IMPORT_MAX_RUNNING
+    at a time. With cleanup set the source file is removed once the import
+    finishes. Unless queue is False, raises a 429 if IMPORT_QUEUE_LIMIT
+    imports are already waiting; the import is then marked failed.
+    '''
+    global _active
+    with _activeLock:
+        full = queue and _active >= IMPORT_MAX_RUNNING + IMPORT_QUEUE_LIMIT
+        if not full:
+            _active += 1
+    if full:
+        importTable.set_status(import_id, FAILED)
+        record = importTable.get_import(import_id)
+        if cleanup and os.path.exists(record["source"]):
+            os.remove(record["source"])
+        raise HTTPException(status_code=429, detail="Too many imports in progress, try again later.")
+
+    def run():
+        global _active
+        try:
+            run_import(import_id, _workers, pool=_pool)
+        except ImportInUse:
+            logger.info("Import %s is being run by another process", import_id)
+        except Exception:
+            logger.exception("Import %s failed", import_id)
+            importTable.set_status(import_id, FAILED)
+        finally:
+            with _activeLock:
+                _active -= 1
+        record = importTable.get_import(import_id)
+        if cleanup and record["status"] != RUNNING and os.path.exists(record["source"]):
+            os.remove(record["source"])
+
+    return _runner.submit(run)
+
+def has_capacity() -> bool:
+    '''
+    Whether start_import would accept another import right now.
+    '''
+    with _activeLock:
+        return _active < IMPORT_MAX_RUNNING + IMPORT_QUEUE_LIMIT
+
+
+def start(workers: int = IMPORT_WORKERS):
+    '''
+    Starts the shared hashing pool and resumes imports left running by the last run.
+    '''
+    global _pool, _runner, _workers
+    _stopping.clear()
+    _workers = max(1, workers)
+    _pool = ProcessPoolExecutor(max_workers=_workers, mp_context=multiprocessing.get_context("spawn"))
+    _runner = ThreadPoolExecutor(max_workers=IMPORT_MAX_RUNNING, thread_name_prefix="import")
+    for import_id in importTable.running_imports():
+        record = importTable.get_import(import_id)
+        start_import(import_id, cleanup=record["source"].startswith(IMPORT_DIRECTORY), queue=False)
+
+
+def stop():
+    '''
+    Running imports stop after their current batch, and they and any still
+    queued resume on the next start.
+    '''
+    global _pool, _runner
+    _stopping.set()
+    if _runner is not None:
+        _runner.shutdown(wait=True, cancel_futures=True)
+        _runner = None
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterator, List
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+# Absolute path of the SQLite database. Defaults to library.db next to this
+# file so the server no longer depends on the directory it was started from.
+DB_PATH = os.path.abspath(os.environ.get("BOOKSHELF_DB_PATH", Path(__file__).parent / "library.db"))
+
+# How long a connection waits on a locked database before giving up.
+BUSY_TIMEOUT_MS = int(os.environ.get("BOOKSHELF_DB_BUSY_TIMEOUT_MS", 5000))
+
+# Prepared statements kept per connection, keyed by SQL text.
+CACHED_STATEMENTS = 256
+
+# SQLite's busy handler first sleeps for 1ms, so an uncontended BEGIN
+# IMMEDIATE is far quicker than this and a slower one had to retry.
+BUSY_RETRY_SECONDS = 0.001
+
+
+@lru_cache(maxsize=1024)
+def statement_kind(sql: str) -> str:
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+
+class TimedConnection(sqlite3.Connection):
+    '''
+    A connection that times every statement into metrics.dbQuerySeconds,
+    labelled by its first keyword (SELECT, INSERT, ...).
+    '''
+    def execute(self, sql: str, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.dbQuerySeconds.observe(time.perf_counter() - start, statement_kind(sql))
+
+    def executemany(self, sql: str, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.dbQuerySeconds.observe(time.perf_counter() - start, statement_kind(sql))
+
+
+class Database:
+    '''
+    Hands out one long-lived connection per thread (and per process, so the
+    worker pool gets its own). Connections run in autocommit mode; writes go
+    through transaction(), which takes the write lock up front so concurrent
+    writers wait on busy_timeout instead of failing with "database is locked".
+    Because connections are reused, sqlite3's statement cache keeps prepared
+    statements around between requests.
+    '''
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._generation = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+            factory=TimedConnection,
+        )
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        con.execute("PRAGMA cache_size = -16000")
+        # Off by default in SQLite; without it ON DELETE CASCADE does nothing
+        con.execute("PRAGMA foreign_keys = ON")
+        with self._lock:
+            self._connections.append(con)
+        return con
+
+    def connection(self) -> sqlite3.Connection:
+        '''
+        Returns this thread's connection, opening it on first use.
+        '''
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.key != (os.getpid(), self._generation):
+            con = self._connect()
+            self._local.con = con
+            self._local.key = (os.getpid(), self._generation)
+        return con
+
+    def _after_commit(self) -> List[Callable[[], None]]:
+        if not hasattr(self._local, "after_commit"):
+            self._local.after_commit = []
+        return self._local.after_commit
+
+    def after_commit(self, callback: Callable[[], None]):
+        '''
+        Runs callback once the current transaction commits, or straight away
+        outside a transaction. Callbacks from a block that rolls back are dropped.
+        '''
+        if self.connection().in_transaction:
+            self._after_commit().append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        '''
+        Runs the block in a write transaction, committing on success and
+        rolling back on error. Nested calls run in a savepoint inside the
+        outer transaction, so a failing nested block is undone on its own.
+        '''
+        con = self.connection()
+        callbacks = self._after_commit()
+        if con.in_transaction:
+            mark = len(callbacks)
+            con.execute("SAVEPOINT nested")
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK TO nested")
+                con.execute("RELEASE nested")
+                del callbacks[mark:]
+                raise
+            con.execute("RELEASE nested")
+            return
+        callbacks.clear()
+        start = time.perf_counter()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                metrics.dbLockTimeouts.inc()
+            raise
+        locked = time.perf_counter()
+        metrics.dbLockWaitSeconds.observe(locked - start)
+        if locked - start >= BUSY_RETRY_SECONDS:
+            metrics.dbLockWaits.inc()
+        try:
+            yield con
+        except BaseException:
+            con.rollback()
+            callbacks.clear()
+            metrics.dbTransactionSeconds.observe(time.perf_counter() - locked)
+            raise
+        con.commit()
+        metrics.dbTransactionSeconds.observe(time.perf_counter() - locked)
+        pending = callbacks[:]
+        callbacks.clear()
+        for callback in pending:
+            callback()
+
+    def close(self):
+        '''
+        Closes every connection; threads reconnect on their next call.
+        '''
+        with self._lock:
+            for con in self._connections:
+                con.close()
+            self._connections.clear()
+            self._generation += 1
+
+
+db = Database()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from typing import Callable, Iterable
+import os
+import tempfile
+import threading
+
+
+class DiskCache:
+    '''
+    A size-bounded LRU cache of files in one directory. Entries are built on
+    first request by a callback that writes the file, and the least recently
+    used entries are removed once the directory grows past max_bytes.
+    '''
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        self._loaded = False
+
+    def _load(self):
+        # Rebuild the LRU order from modification times left by earlier runs.
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total += size
+        self._loaded = True
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return key in self._entries
+
+    def get_or_create(self, key: str, build: Callable[[str], None]) -> str:
+        '''
+        Returns the path of the cached file for key, calling build(path) to
+        write it first if it isn't cached yet.
+        '''
+        path = self.path(key)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if key in self._entries and os.path.exists(path):
+                self._entries.move_to_end(key)
+                os.utime(path)
+                return path
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.build-')
+        os.close(fd)
+        try:
+            build(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = os.path.getsize(path)
+            self._total += self._entries[key]
+            self._evict(keep=key)
+        return path
+
+    def _evict(self, keep: str):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            key, size = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self._total -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def discard_prefixes(self, prefixes: Iterable[str]) -> int:
+        '''
+        Removes every entry whose key starts with one of prefixes. Returns
+        the number removed.
+        '''
+        prefixes = tuple(prefixes)
+        if not prefixes:
+            return 0
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            keys = [key for key in self._entries if key.startswith(prefixes)]
+            for key in keys:
+                self._total -= self._entries.pop(key)
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+        return len(keys)
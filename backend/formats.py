@@ -0,0 +1,323 @@
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, Dict, List
+from urllib.parse import unquote
+import posixpath
+import subprocess
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+# pdf2image and Pillow are only needed to render, which happens in the job
+# and page workers, so they are imported there
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Per-format ingest handlers, keyed on the file type detected at upload.
+# Each handler knows how to render a cover image, read metadata and pull out
+# searchable text for its format; thumbnail, metadata and text jobs look the
+# handler up instead of assuming every book is a PDF.
+
+# pdfinfo only reads the trailer, info dictionary and metadata stream, but
+# give up on a damaged file rather than hang a worker.
+METADATA_TIMEOUT = 30
+XMP_NAMESPACES = {
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "xmp": "http://ns.adobe.com/xap/1.0/",
+}
+# Largest cover image or XML file read out of an EPUB, uncompressed.
+EPUB_MAX_MEMBER_SIZE = 32 * 1024 * 1024
+# Largest EPUB cover decoded, in pixels. A small compressed image can still
+# declare huge dimensions, so this is checked from the header before decoding.
+EPUB_MAX_COVER_PIXELS = 40 * 1000 * 1000
+
+
+class FormatHandler:
+    '''
+    Base class for a book format. file_type is the stored file extension
+    and media_type the MIME type libmagic reports for it.
+    '''
+    file_type: str = ""
+    media_type: str = ""
+
+    def render_cover(self, file_location: str, width: int) -> "Image.Image":
+        '''
+        Returns the cover as an RGB image at least width pixels wide where
+        the source allows.
+        '''
+        raise NotImplementedError
+
+    def render_page(self, file_location: str, page: int, width: int) -> "Image.Image":
+        '''
+        Returns page (from 1) as an RGB image width pixels wide. Raises
+        IndexError past the last page. Only paginated formats implement it.
+        '''
+        raise NotImplementedError(f"{self.file_type} books have no fixed pages")
+
+    def read_metadata(self, file_location: str) -> Dict:
+        '''
+        Returns any of title, author, page_count, language and published
+        (YYYY-MM-DD) that the file records.
+        '''
+        return {}
+
+    def extract_text(self, file_location: str, max_bytes: int) -> str:
+        return ""
+
+
+_handlers: Dict[str, FormatHandler] = {}
+
+def register(handler_class):
+    '''
+    Class decorator adding a handler to the registry.
+    '''
+    handler = handler_class()
+    _handlers[handler.file_type] = handler
+    return handler_class
+
+def handler_for(file_type: str) -> FormatHandler:
+    if file_type not in _handlers:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    return _handlers[file_type]
+
+def handler_for_location(file_location: str) -> FormatHandler:
+    return handler_for(posixpath.splitext(file_location)[1].lstrip('.'))
+
+def handler_for_media_type(media_type: str) -> FormatHandler | None:
+    for handler in _handlers.values():
+        if handler.media_type == media_type:
+            return handler
+    return None
+
+def media_types() -> Dict[str, str]:
+    return {file_type: handler.media_type for file_type, handler in _handlers.items()}
+
+
+@register
+class PdfHandler(FormatHandler):
+    file_type = "pdf"
+    media_type = "application/pdf"
+
+    def render_cover(self, file_location: str, width: int) -> "Image.Image":
+        return self.render_page(file_location, 1, width)
+
+    def render_page(self, file_location: str, page: int, width: int) -> "Image.Image":
+        from pdf2image import convert_from_path
+        # poppler renders just the one page, straight at the requested width
+        image_list = convert_from_path(
+            file_location, first_page=page, last_page=page, fmt='ppm', size=(width, None)
+        )
+        if not image_list:
+            raise IndexError(f"Page {page} is past the end of the book")
+        return image_list[0].convert("RGB")
+
+    def info(self, file_location: str) -> Dict[str, str]:
+        '''
+        Reads the info dictionary (Title, Author, Pages, CreationDate, ...)
+        with poppler's pdfinfo.
+        '''
+        output = subprocess.run(
+            ["pdfinfo", "-isodates", "-enc", "UTF-8", file_location],
+            capture_output=True, check=True, timeout=METADATA_TIMEOUT
+        ).stdout.decode("utf-8", errors="ignore")
+        info = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition(":")
+            if sep and value.strip():
+                info[key.strip()] = value.strip()
+        return info
+
+    def xmp(self, file_location: str) -> Dict[str, str]:
+        '''
+        Reads the title, creators, language and creation date from the XMP
+        metadata stream, if there is one.
+        '''
+        output = subprocess.run(
+            ["pdfinfo", "-meta", file_location],
+            capture_output=True, check=True, timeout=METADATA_TIMEOUT
+        ).stdout
+        if not output.strip():
+            return {}
+        try:
+            root = ElementTree.fromstring(output)
+        except ElementTree.ParseError:
+            return {}
+
+        def items(path: str) -> List[str]:
+            found = root.findall(f".//{path}//rdf:li", XMP_NAMESPACES) or root.findall(f".//{path}", XMP_NAMESPACES)
+            return [element.text.strip() for element in found if element.text and element.text.strip()]
+
+        xmp = {}
+        for key, path in (("title", "dc:title"), ("author", "dc:creator"), ("language", "dc:language"), ("published", "xmp:CreateDate")):
+            values = items(path)
+            if values:
+                xmp[key] = ", ".join(values) if key == "author" else values[0]
+        return xmp
+
+    def read_metadata(self, file_location: str) -> Dict:
+        # The info dictionary wins where both it and the XMP packet have a value
+        info = self.info(file_location)
+        try:
+            xmp = self.xmp(file_location)
+        except (subprocess.SubprocessError, OSError):
+            xmp = {}
+        published = info.get("CreationDate") or xmp.get("published")
+        return {
+            "title": info.get("Title") or xmp.get("title"),
+            "author": info.get("Author") or xmp.get("author"),
+            "page_count": int(info["Pages"]) if info.get("Pages", "").isdigit() else None,
+            "language": xmp.get("language"),
+            "published": published[:10] if published else None,
+        }
+
+    def extract_text(self, file_location: str, max_bytes: int) -> str:
+        '''
+        Extracts the body text with poppler's pdftotext, reading at most
+        max_bytes of output.
+        '''
+        process = subprocess.Popen(
+            ["pdftotext", "-enc", "UTF-8", "-q", file_location, "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        try:
+            text = process.stdout.read(max_bytes)
+        finally:
+            process.kill()
+            process.wait()
+        return text.decode("utf-8", errors="ignore")
+
+
+class _TextCollector(HTMLParser):
+    # Collects the visible text of an XHTML document
+    def __init__(self):
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip and data.strip():
+            self.parts.append(data.strip())
+
+
+@register
+class EpubHandler(FormatHandler):
+    '''
+    EPUBs are zip archives. Everything is read member by member through the
+    zip's central directory, so the archive is never extracted to disk.
+    '''
+    file_type = "epub"
+    media_type = "application/epub+zip"
+
+    def _read(self, archive: zipfile.ZipFile, name: str) -> bytes:
+        info = archive.getinfo(name)
+        if info.file_size > EPUB_MAX_MEMBER_SIZE:
+            raise ValueError(f"{name} is too large")
+        return archive.read(info)
+
+    def package(self, archive: zipfile.ZipFile) -> Dict:
+        '''
+        Parses the OPF package document named in META-INF/container.xml.
+        Returns its metadata element, manifest (id -> (path, media type,
+        properties)), spine (list of ids) and the package's path.
+        '''
+        container = ElementTree.fromstring(self._read(archive, "META-INF/container.xml"))
+        rootfile = container.find(".//{*}rootfile")
+        if rootfile is None or not rootfile.get("full-path"):
+            raise ValueError("EPUB has no package document")
+        opf_path = rootfile.get("full-path")
+        opf = ElementTree.fromstring(self._read(archive, opf_path))
+
+        base = posixpath.dirname(opf_path)
+        manifest = {}
+        for item in opf.findall(".//{*}manifest/{*}item"):
+            href = item.get("href")
+            if item.get("id") and href:
+                path = posixpath.normpath(posixpath.join(base, unquote(href)))
+                manifest[item.get("id")] = (path, item.get("media-type", ""), item.get("properties", ""))
+        spine = [itemref.get("idref") for itemref in opf.findall(".//{*}spine/{*}itemref")]
+        return {"metadata": opf.find(".//{*}metadata"), "manifest": manifest, "spine": spine}
+
+    def cover_path(self, package: Dict) -> str | None:
+        manifest = package["manifest"]
+        # EPUB 3 marks the cover in the manifest
+        for path, media_type, properties in manifest.values():
+            if "cover-image" in properties.split():
+                return path
+        # EPUB 2 points at it from <meta name="cover" content="item id">
+        metadata = package["metadata"]
+        if metadata is not None:
+            for meta in metadata.findall("{*}meta"):
+                if meta.get("name") == "cover" and meta.get("content") in manifest:
+                    return manifest[meta.get("content")][0]
+        # Otherwise guess: an image called cover, then the first image
+        images = [(item_id, path) for item_id, (path, media_type, _) in manifest.items() if media_type.startswith("image/")]
+        for item_id, path in images:
+            if "cover" in item_id.lower() or "cover" in posixpath.basename(path).lower():
+                return path
+        return images[0][1] if images else None
+
+    def render_cover(self, file_location: str, width: int) -> "Image.Image":
+        from PIL import Image
+        with zipfile.ZipFile(file_location) as archive:
+            path = self.cover_path(self.package(archive))
+            if path is None:
+                raise ValueError("EPUB has no cover image")
+            info = archive.getinfo(path)
+            if info.file_size > EPUB_MAX_MEMBER_SIZE:
+                raise ValueError(f"{path} is too large")
+            with archive.open(info) as member:
+                image = Image.open(member)
+                if image.width * image.height > EPUB_MAX_COVER_PIXELS:
+                    raise ValueError(f"{path} is {image.width}x{image.height}, too large to decode")
+                # Let JPEG decode at a reduced scale when the cover is much larger
+                image.draft("RGB", (width, width * 4))
+                return image.convert("RGB")
+
+    def read_metadata(self, file_location: str) -> Dict:
+        with zipfile.ZipFile(file_location) as archive:
+            metadata = self.package(archive)["metadata"]
+        if metadata is None:
+            return {}
+
+        def values(tag: str) -> List[str]:
+            return [element.text.strip() for element in metadata.findall(f"{{*}}{tag}") if element.text and element.text.strip()]
+
+        titles, creators, languages, dates = values("title"), values("creator"), values("language"), values("date")
+        return {
+            "title": titles[0] if titles else None,
+            "author": ", ".join(creators) if creators else None,
+            "language": languages[0] if languages else None,
+            "published": dates[0][:10] if dates else None,
+        }
+
+    def extract_text(self, file_location: str, max_bytes: int) -> str:
+        '''
+        Extracts the text of the spine documents in reading order, stopping
+        once max_bytes have been collected.
+        '''
+        parts = []
+        total = 0
+        with zipfile.ZipFile(file_location) as archive:
+            package = self.package(archive)
+            for item_id in package["spine"]:
+                if item_id not in package["manifest"] or total >= max_bytes:
+                    continue
+                path, media_type, _ = package["manifest"][item_id]
+                if "html" not in media_type:
+                    continue
+                try:
+                    collector = _TextCollector()
+                    collector.feed(self._read(archive, path).decode("utf-8", errors="ignore"))
+                except (KeyError, ValueError):
+                    continue
+                text = "\n".join(collector.parts)
+                parts.append(text)
+                total += len(text.encode("utf-8"))
+        return "\n".join(parts).encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
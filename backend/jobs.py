@@ -0,0 +1,238 @@
+from typing import Dict, List
+from concurrent.futures import Future, ProcessPoolExecutor
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import librarytools
+import metrics
+import uploads
+from librarycache import libraryCache
+from database import Database, db
+
+# Background job queue for work that is too slow to run inside a request,
+# such as rendering thumbnails or extracting text for search. Jobs are stored in the database so anything
+# still pending when the server stops is picked up again on the next start.
+
+# Number of worker processes; defaults to one per core.
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", os.cpu_count() or 1))
+# Books that predate metadata extraction are queued this many at a time,
+# and only once the queue has drained, so the backfill never crowds out uploads.
+METADATA_BACKFILL_BATCH = int(os.environ.get("METADATA_BACKFILL_BATCH", 50))
+METADATA_BACKFILL_INTERVAL = float(os.environ.get("METADATA_BACKFILL_INTERVAL", 5))
+# Files of deleted books are removed right after the delete request; this
+# sweep catches whatever a crash or restart left behind.
+TOMBSTONE_SWEEP_INTERVAL = float(os.environ.get("TOMBSTONE_SWEEP_INTERVAL", 300))
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_pool: ProcessPoolExecutor | None = None
+
+logger = logging.getLogger("bookshelf.jobs")
+
+
+class JobTable:
+    def __init__(self, database: Database = db):
+        self.database = database
+
+    def add_job(self, book_id: str, kind: str, file_location: str) -> int:
+        now = int(time.time())
+        with self.database.transaction() as con:
+            cursor = con.execute(
+                "INSERT INTO jobs (book_id, kind, file_location, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (book_id, kind, file_location, PENDING, now, now)
+            )
+            return cursor.lastrowid
+
+    def set_status(self, job_id: int, status: str, error: str | None = None):
+        with self.database.transaction() as con:
+            con.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, int(time.time()), job_id)
+            )
+
+    def unfinished_jobs(self) -> List[tuple]:
+        cursor = self.database.connection().execute(
+            "SELECT id, book_id, kind, file_location FROM jobs WHERE status IN (?, ?) ORDER BY id",
+            (PENDING, RUNNING)
+        )
+        return cursor.fetchall()
+
+    def unfinished_count(self) -> int:
+        return self.database.connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (PENDING, RUNNING)
+        ).fetchone()[0]
+
+    def books_missing_metadata(self, limit: int) -> List[tuple]:
+        '''
+        Returns (id, file_type, content_hash) for books that have never had
+        their metadata read and have no metadata job queued, one per stored file.
+        '''
+        cursor = self.database.connection().execute("""
+            SELECT id, file_type, content_hash FROM books
+            WHERE metadata_at IS NULL AND NOT EXISTS (
+                SELECT 1 FROM jobs WHERE jobs.book_id = books.id AND jobs.kind = 'metadata' AND jobs.status IN (?, ?)
+            )
+            GROUP BY IFNULL(content_hash, id)
+            LIMIT ?
+        """, (PENDING, RUNNING, limit))
+        return cursor.fetchall()
+
+    def jobs_for_book(self, book_id: str) -> List[Dict]:
+        keys = ['kind', 'status', 'error', 'created_at', 'updated_at']
+        cursor = self.database.connection().execute(
+            "SELECT kind, status, error, created_at, updated_at FROM jobs WHERE book_id = ? ORDER BY id",
+            (book_id,)
+        )
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+
+jobTable = JobTable()
+
+
+def run_job(job_id: int, kind: str, book_id: str, file_location: str):
+    '''
+    Entry point inside the worker process.
+    '''
+    jobTable.set_status(job_id, RUNNING)
+    # Jobs queued before the sharded layout hold flat paths
+    file_location = librarytools.locate(file_location)
+    if kind == "thumbnail":
+        librarytools.generate_thumbnail(file_location)
+    elif kind == "text":
+        librarytools.index_book_text(book_id, file_location)
+    elif kind == "metadata":
+        librarytools.index_book_metadata(book_id, file_location)
+    else:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+
+def _on_job_done(job_id: int, kind: str, book_id: str, started: float, future: Future):
+    # Cancelled jobs stay pending and are resumed on the next start.
+    if future.cancelled():
+        return
+    if kind == "metadata":
+        # The worker may have changed titles and authors, and its own cache
+        # bumps happened in the worker process
+        for user_id in librarytools.book_owners(book_id):
+            libraryCache.bump(user_id)
+    error = future.exception()
+    metrics.jobSeconds.observe(time.perf_counter() - started, kind, FAILED if error else DONE)
+    if error is not None:
+        logger.warning("Job failed", extra={"job_id": job_id, "kind": kind, "error": str(error)})
+        metrics.jobFailures.inc(kind)
+        jobTable.set_status(job_id, FAILED, str(error))
+    else:
+        jobTable.set_status(job_id, DONE)
+
+
+def _dispatch(job_id: int, kind: str, book_id: str, file_location: str):
+    started = time.perf_counter()
+    future = _pool.submit(run_job, job_id, kind, book_id, file_location)
+    future.add_done_callback(lambda f: _on_job_done(job_id, kind, book_id, started, f))
+
+
+def start(workers: int = THUMBNAIL_WORKERS, resume: bool = True):
+    '''
+    Starts the worker pool and, if resume is set, requeues any jobs left
+    over from the last run.
+    '''
+    global _pool
+    _pool = ProcessPoolExecutor(
+        max_workers=max(1, workers),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+    if not resume:
+        return
+    for job_id, book_id, kind, file_location in jobTable.unfinished_jobs():
+        jobTable.set_status(job_id, PENDING)
+        _dispatch(job_id, kind, book_id, file_location)
+
+
+def stop(wait: bool = False):
+    '''
+    Stops the worker pool. With wait set, queued jobs are finished first;
+    otherwise they stay pending for the next start.
+    '''
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=wait, cancel_futures=not wait)
+        _pool = None
+
+
+def submit(book_id: str, kind: str, file_location: str) -> str:
+    '''
+    Persists a job and hands it to the worker pool. Returns the job status.
+    '''
+    job_id = jobTable.add_job(book_id, kind, file_location)
+    if _pool is not None:
+        _dispatch(job_id, kind, book_id, file_location)
+    return PENDING
+
+
+def submit_many(entries: List[tuple]):
+    '''
+    Persists a batch of (book_id, kind, file_location) jobs in one
+    transaction, then hands them to the worker pool.
+    '''
+    with jobTable.database.transaction():
+        jobIds = [jobTable.add_job(*entry) for entry in entries]
+    if _pool is not None:
+        for job_id, (book_id, kind, file_location) in zip(jobIds, entries):
+            _dispatch(job_id, kind, book_id, file_location)
+
+
+def status(book_id: str) -> List[Dict]:
+    return jobTable.jobs_for_book(book_id)
+
+
+def queue_metadata_backfill(batch_size: int = METADATA_BACKFILL_BATCH) -> int:
+    '''
+    Queues metadata jobs for the next batch of books without metadata.
+    Returns the number queued.
+    '''
+    books = jobTable.books_missing_metadata(batch_size)
+    submit_many([
+        (book_id, "metadata", librarytools.blob_location(content_hash or book_id, file_type))
+        for book_id, file_type, content_hash in books
+    ])
+    return len(books)
+
+
+async def backfill_metadata(batch_size: int = METADATA_BACKFILL_BATCH,
+                            interval: float = METADATA_BACKFILL_INTERVAL):
+    '''
+    Background task: reads metadata for books added before extraction
+    existed, a batch at a time whenever the job queue is nearly empty.
+    Finishes once every book has been read.
+    '''
+    while True:
+        try:
+            if await asyncio.to_thread(jobTable.unfinished_count) < batch_size:
+                queued = await asyncio.to_thread(queue_metadata_backfill, batch_size)
+                if queued == 0:
+                    return
+                logger.info("Queued metadata backfill", extra={"books": queued})
+        except Exception:
+            logger.exception("Metadata backfill failed")
+        await asyncio.sleep(interval)
+
+async def sweep_deleted_files(interval: float = TOMBSTONE_SWEEP_INTERVAL):
+    '''
+    Background task: removes the files of deleted books and abandoned
+    uploads every interval, starting with anything left over from before
+    the server started.
+    '''
+    while True:
+        try:
+            cleared = await asyncio.to_thread(librarytools.sweep_tombstones)
+            if cleared:
+                logger.info("Removed files of deleted books", extra={"tombstones": cleared})
+            await asyncio.to_thread(uploads.expire_sessions)
+        except Exception:
+            logger.exception("Tombstone sweep failed")
+        await asyncio.sleep(interval)
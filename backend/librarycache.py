@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, NamedTuple
+import hashlib
+import os
+import threading
+import time
+
+# Library pages are cached per user, already serialized, so repeat page
+# loads skip SQLite and JSON encoding entirely. Each user has a version
+# counter that is bumped after any write to their books commits; cached
+# pages from an older version are never served. Entries also expire after
+# LIBRARY_CACHE_TTL seconds, which bounds staleness from writers outside
+# this process (e.g. scripts/bulk_import.py).
+LIBRARY_CACHE_BYTES = int(os.environ.get("LIBRARY_CACHE_BYTES", 32 * 1024 * 1024))
+LIBRARY_CACHE_TTL = float(os.environ.get("LIBRARY_CACHE_TTL", 60))
+
+
+class CachedPage(NamedTuple):
+    version: int
+    created: float
+    etag: str
+    payload: bytes
+
+
+class LibraryCache:
+    '''
+    A size-bounded LRU of serialized library pages keyed by
+    (user_id, query parameters), with per-user version counters.
+    '''
+    def __init__(self, max_bytes: int = LIBRARY_CACHE_BYTES, ttl: float = LIBRARY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, CachedPage] = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, user_id: int):
+        '''
+        Marks every cached page of a user as stale.
+        '''
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def get(self, user_id: int, params: Hashable, build: Callable[[], bytes]) -> CachedPage:
+        '''
+        Returns the cached page for params, calling build() to serialize it
+        if there is no current entry.
+        '''
+        key = (user_id, params)
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version and time.monotonic() - entry.created < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        payload = build()
+        # The ETag depends only on the content, so a rebuilt but unchanged page still revalidates
+        entry = CachedPage(version, time.monotonic(), f'"{hashlib.blake2b(payload, digest_size=16).hexdigest()}"', payload)
+        with self._lock:
+            # Don't cache a page built while a write to this user's books landed
+            if self._versions.get(user_id, 0) == version and len(payload) <= self.max_bytes:
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self._bytes -= len(previous.payload)
+                self._entries[key] = entry
+                self._bytes += len(payload)
+                self._evict()
+        return entry
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= len(entry.payload)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+            }
+
+
+libraryCache = LibraryCache()
@@ -1,199 +1,597 @@
-from typing import Dict, List
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, Tuple
 import uuid
+import base64
+import json
+import re
 import os
 import sqlite3
-import magic
-from pdf2image import convert_from_bytes
+import hashlib
+import logging
+import tempfile
 from fastapi import HTTPException
-import glob
 import time
-from requests import Request
+from database import Database, db
+import formats
+import metrics
+from librarycache import libraryCache
+from filecache import DiskCache
+import pages
+
+# libmagic and Pillow are imported where they're used, so processes that
+# never sniff an upload or touch an image don't load them
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger("bookshelf.library")
+
+# Uploads are copied to disk in fixed-size chunks so memory use per upload
+# stays constant no matter how large the book is.
+CHUNK_SIZE = 1024 * 1024
+SNIFF_SIZE = 2048
+# Largest book accepted, however it arrives: /upload, resumable uploads or imports
+UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 4 * 1024 * 1024 * 1024))
+
+MEDIA_TYPES = formats.media_types()
+
+# Library listing sort keys, mapped to the column each one orders by.
+# author_sort is a generated column so books without an author still page.
+# Every key has a covering index on (user_id, key, id, ...) so a page is
+# read straight from the index.
+LIBRARY_SORT_KEYS = {
+    "title": "title",
+    "author": "author_sort",
+    "added": "added_at",
+}
+# Thumbnails are rendered once at the large width and downscaled into the
+# named renditions below. Other widths are built on demand into a disk cache.
+THUMBNAIL_SIZES = {"small": 160, "medium": 320, "large": 640}
+THUMBNAIL_MIN_WIDTH = 32
+THUMBNAIL_FORMATS = {"avif": "AVIF", "webp": "WEBP"}
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", 256 * 1024 * 1024))
+
+# Thumbnail widths and formats other than the named WebP sizes, built on request
+thumbnailCache = DiskCache('./thumbnails/cache', THUMBNAIL_CACHE_BYTES)
+
+LIBRARY_PAGE_SIZE = 100
+LIBRARY_MAX_PAGE_SIZE = 1000
+# Most books one batch delete request may remove
+DELETE_BATCH_MAX = int(os.environ.get("DELETE_BATCH_MAX", 1000))
+
+# Search ranks title matches above author matches above body matches (BM25 weights).
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+SEARCH_MAX_RESULTS = 100
+# Extracted body text is capped so one huge book can't bloat the index.
+SEARCH_MAX_TEXT = 2 * 1024 * 1024
+# Shorter prefixes expand to most of the index and make ranking slow.
+SEARCH_MIN_PREFIX = 3
+# Words are indexed as the owner's search prefix followed by the word
+# ("u0000002ax" + "river"), so a match only reads its own user's part of the
+# index instead of every user's. Words are what unicode61 keeps together.
+SEARCH_WORD = re.compile(r"[^\W_]+")
+
+# Columns filled in by the background metadata job, with their types
+METADATA_COLUMNS = {
+    "page_count": "INTEGER",
+    "byte_size": "INTEGER",
+    "language": "TEXT",
+    "published": "TEXT",
+    "metadata_at": "INTEGER",
+}
 
 class UserTable:
-    def __init__(self):
-        self.database = 'library.db'
+    def __init__(self, database: Database = db):
+        self.database = database
 
     def usernameCheck(self, username : str) -> tuple | None:
-        try:
-            with sqlite3.connect(self.database) as con:
-                cursor = con.cursor()
-                cursor.execute("SELECT id, username, password FROM users WHERE username = ?", (username,))
-                return cursor.fetchone()
-        except Exception as e:
-            raise
-        return ()
-    
+        cursor = self.database.connection().execute(
+            "SELECT id, username, password FROM users WHERE username = ?", (username,)
+        )
+        return cursor.fetchone()
+
     def addUser(self, username : str, password: str):
-        try:
-            with sqlite3.connect(self.database) as con:
-                cursor = con.cursor()
-                cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-                con.commit()
-        except Exception as e:
-            raise
+        with self.database.transaction() as con:
+            con.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
 
 # Refresh Tokens Table Class
 class RTT:
-    def __init__(self):
-        self.database = 'library.db'
-    
+    def __init__(self, database: Database = db):
+        self.database = database
+
     def store_refresh_token(self, jti: str, username: str, expires_at: int):
-        try:
-            with sqlite3.connect(self.database) as con:
-                cursor = con.cursor()
-                cursor.execute("INSERT INTO refresh_tokens (jti, username, expires_at, revoked) VALUES (?, ?, ?, ?)", (jti, username, expires_at, 0))
-                con.commit()
-        except Exception as e:
-            raise
-    
-    def revoke_refresh_token(self, jti: str):
-        try:
-            with sqlite3.connect(self.database) as con:
-                cursor = con.cursor()
-                cursor.execute("UPDATE refresh_tokens SET revoked = 1 WHERE jti = ?", (jti,))
-                con.commit
-        except Exception as e:
-            raise
-    
-    def is_refresh_token_active(self, jti: str) -> bool:
-        try:
-            with sqlite3.connect(self.database) as con:
-                cursor = con.cursor()
-                cursor.execute("SELECT revoked, expires_at FROM refresh_tokens WHERE jti = ?", (jti,))
-                row = cursor.fetchone()
-                if not row:
-                    return False
-                revoked, expires_at = row
-                if revoked:
-                    return False
-                return int(time.time()) < int(expires_at)
-        except Exception as e:
-            raise
+        with self.database.transaction() as con:
+            con.execute(
+                "INSERT INTO refresh_tokens (jti, username, expires_at, revoked) VALUES (?, ?, ?, ?)",
+                (jti, username, expires_at, 0)
+            )
+
+    def revoke_refresh_token(self, jti: str) -> bool:
+        '''
+        Revokes a token. Returns False if it was already revoked or purged,
+        which also makes the write double as a reuse check.
+        '''
+        with self.database.transaction() as con:
+            cursor = con.execute("UPDATE refresh_tokens SET revoked = 1 WHERE jti = ? AND revoked = 0", (jti,))
+            return cursor.rowcount == 1
+
+    def rotate_refresh_token(self, jti: str, new_jti: str, username: str, expires_at: int) -> bool:
+        '''
+        Revokes a token and stores its replacement in one transaction.
+        Returns False, storing nothing, if the old token was already revoked
+        or purged, so a token can be rotated only once across processes.
+        '''
+        with self.database.transaction() as con:
+            cursor = con.execute("UPDATE refresh_tokens SET revoked = 1 WHERE jti = ? AND revoked = 0", (jti,))
+            if cursor.rowcount != 1:
+                return False
+            con.execute(
+                "INSERT INTO refresh_tokens (jti, username, expires_at, revoked) VALUES (?, ?, ?, ?)",
+                (new_jti, username, expires_at, 0)
+            )
+            return True
+
+    def revoke_user_tokens(self, username: str) -> List[tuple]:
+        '''
+        Revokes every active token of a user ("log out everywhere").
+        Returns the (jti, expires_at) of the tokens revoked.
+        '''
+        with self.database.transaction() as con:
+            cursor = con.execute(
+                "UPDATE refresh_tokens SET revoked = 1 WHERE username = ? AND revoked = 0 AND expires_at > ? RETURNING jti, expires_at",
+                (username, int(time.time()))
+            )
+            return cursor.fetchall()
+
+    def revoked_tokens(self) -> List[tuple]:
+        '''
+        Returns the (jti, expires_at) of revoked tokens that haven't expired yet.
+        '''
+        cursor = self.database.connection().execute(
+            "SELECT jti, expires_at FROM refresh_tokens WHERE revoked = 1 AND expires_at > ?", (int(time.time()),)
+        )
+        return cursor.fetchall()
+
+    def purge_tokens(self, batch_size: int = 1000) -> int:
+        '''
+        Deletes expired and revoked tokens in small batches, so the write
+        lock is never held for long. Returns the number of rows deleted.
+        '''
+        deleted = 0
+        while True:
+            with self.database.transaction() as con:
+                cursor = con.execute("""
+                    DELETE FROM refresh_tokens WHERE rowid IN (
+                        SELECT rowid FROM refresh_tokens WHERE expires_at <= ? OR revoked = 1 LIMIT ?
+                    )
+                """, (int(time.time()), batch_size))
+            deleted += cursor.rowcount
+            if cursor.rowcount == 0:
+                return deleted
 
 def generate_unique_id() -> str:
     '''
-    Generates and returns a unique id so long as there is no
-    PDF with the same name already in the library
+    Generates and returns a random unique id. Files are stored by content
+    hash, so there is no file to check it against; books.id is the primary
+    key and would reject the (vanishingly unlikely) duplicate.
     '''
-    while True:
-        unique_id = str(uuid.uuid4())
-        if not os.path.exists(f"./books/{unique_id}.pdf"):
-            return unique_id
+    return str(uuid.uuid4())
         
+@metrics.timed("file_type_check")
 def file_type_check(stream: str) -> str:
+    '''
+    Sniffs the file type and returns the extension of its format handler.
+    '''
+    import magic
     mime_type = magic.from_buffer(stream, mime=True)
-    if mime_type not in ["application/pdf", "application/epub+zip"]:
+    handler = formats.handler_for_media_type(mime_type)
+    if handler is None:
         raise HTTPException(status_code=400, detail=f"Invalid file type: {mime_type}")
-    if mime_type == "application/pdf":
-        return "pdf"
-    elif mime_type == "application/epub+zip":
-        return "epub"
+    return handler.file_type
     
-def generate_thumbnail(stream: str, bookData: Dict) -> str:
+def shard(directory: str, file_name: str) -> str:
+    '''
+    Stored files are spread over two levels of subdirectories named after
+    the first four characters of the file name, ./books/ab/cd/abcd....pdf,
+    so no single directory grows past a few thousand entries. Names are
+    content hashes or random uuids, so the fan-out is even.
+    '''
+    return f'{directory}/{file_name[:2]}/{file_name[2:4]}/{file_name}'
+
+def blob_location(name: str, file_type: str) -> str:
+    return shard('./books', f'{name}.{file_type}')
+
+def thumbnail_location(name: str, size: str = "large") -> str:
+    return shard('./thumbnails', f'{name}-{size}.webp')
+
+def legacy_thumbnail_location(name: str) -> str:
+    # Full-size JPEG thumbnails written before renditions existed
+    return shard('./thumbnails', f'{name}.jpg')
+
+def flat_location(path: str) -> str:
+    # Where a sharded file was stored before the sharded layout
+    directory, file_name = os.path.split(path)
+    return os.path.join(os.path.dirname(os.path.dirname(directory)), file_name)
+
+def locate(path: str) -> str:
+    '''
+    Finds a stored file from its path in either layout. scripts/shard_storage.py
+    moves files from the flat layout while the server runs, so a file may be
+    at either place, and may move between the two checks; the sharded path
+    is returned if it is at neither.
+    '''
+    directory, file_name = os.path.split(path)
+    if directory.endswith(f'/{file_name[:2]}/{file_name[2:4]}'):
+        sharded, flat = path, flat_location(path)
+    else:
+        sharded, flat = shard(directory, file_name), path
+    for candidate in (sharded, flat):
+        if os.path.exists(candidate):
+            return candidate
+    return sharded
+
+def blob_name(file_location: str) -> str:
+    return os.path.splitext(os.path.basename(file_location))[0]
+
+def storage_name(book: Dict) -> str:
+    '''
+    Books are stored under the SHA-256 of their content. Books uploaded
+    before content-addressed storage are still stored under their id.
+    '''
+    return book.get("content_hash") or book["id"]
+
+@metrics.timed("store_book_stream")
+def store_book_stream(stream: BinaryIO) -> Tuple[str, str, str]:
+    '''
+    Streams a book into a temp file in ./books without holding it in memory.
+    The type is sniffed from the first chunk and the content is hashed as it
+    is written; store_book_blob then moves it into place. Books over
+    UPLOAD_MAX_SIZE are refused with a 413.
+    Returns the temp file location, the file extension and the SHA-256 of the content.
+    '''
+    os.makedirs('./books', exist_ok=True)
+    chunk = stream.read(CHUNK_SIZE)
+    file_extension = file_type_check(chunk[:SNIFF_SIZE])
+
+    hasher = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir='./books', prefix='.upload-', suffix='.part')
     try:
-        image_list = convert_from_bytes(stream, first_page=1, last_page=1, fmt='jpg') 
-        thumbnail = image_list[0]
-        os.makedirs('./thumbnails', exist_ok=True)
+        with os.fdopen(fd, 'wb') as buffer:
+            while chunk:
+                size += len(chunk)
+                if size > UPLOAD_MAX_SIZE:
+                    raise HTTPException(status_code=413, detail=f"Books are limited to {UPLOAD_MAX_SIZE} bytes.")
+                hasher.update(chunk)
+                buffer.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+            buffer.flush()
+            os.fsync(buffer.fileno())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, file_extension, hasher.hexdigest()
 
-        thumbnailPath = f'./thumbnails/{bookData['id']}.jpg'
+@metrics.timed("store_book_blob")
+def store_book_blob(bookData: Dict, temp_location: str) -> bool:
+    '''
+    Registers a book and, once the transaction it runs in commits, moves
+    its temp file into the blob store named by content hash (see
+    place_blob). A rollback leaves no stored file behind, and the temp file
+    is removed if registering fails. Returns True if the content is new,
+    so the caller knows to thumbnail it and extract its text.
+    '''
+    try:
+        with db.transaction() as con:
+            create_library_entry(bookData)
+            refcount = con.execute(
+                "SELECT refcount FROM blobs WHERE hash = ?", (bookData["content_hash"],)
+            ).fetchone()[0]
+            db.after_commit(lambda: place_blob(bookData["content_hash"], bookData["file_type"], temp_location))
+    except BaseException:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+    return refcount == 1
 
-        thumbnail.save(thumbnailPath)
-        return thumbnailPath
+def place_blob(content_hash: str, file_type: str, temp_location: str):
+    '''
+    Moves a temp file into the blob store if its content is still
+    registered and not already stored, and otherwise discards it. Runs
+    under the database write lock so a sweep of the same content can't
+    remove the blob underneath us.
+    '''
+    try:
+        with db.transaction() as con:
+            if con.execute("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)).fetchone():
+                location = blob_location(content_hash, file_type)
+                if not os.path.exists(locate(location)):
+                    os.makedirs(os.path.dirname(location), exist_ok=True)
+                    os.replace(temp_location, location)
+    finally:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+
+def generate_thumbnail(file_location: str) -> str:
+    '''
+    Renders the cover of a stored book once, at the large rendition width,
+    using the handler for its format, and saves every named rendition as
+    WebP. The thumbnails share the book's blob name. Returns the large
+    rendition's path.
+    '''
+    try:
+        handler = formats.handler_for_location(file_location)
+        thumbnail = handler.render_cover(file_location, THUMBNAIL_SIZES["large"])
+        name = blob_name(file_location)
+        os.makedirs(os.path.dirname(thumbnail_location(name)), exist_ok=True)
+        for size, width in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+            rendition = resize_to_width(thumbnail, width)
+            save_image_atomic(rendition, thumbnail_location(name, size), "WEBP")
+        return thumbnail_location(name)
     except Exception as e:
-        print(f"Error: {e}")
+        logger.warning("Thumbnail rendering failed", extra={"file": file_location, "error": str(e)})
         raise
 
-def create_library_entry(bookData: Dict) -> bool: # NOTE: Use transactions later maybe?
+def resize_to_width(image: "Image.Image", width: int) -> "Image.Image":
+    from PIL import Image
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+def save_image_atomic(image: "Image.Image", path: str, format: str):
+    temp_path = f"{path}.part"
+    image.save(temp_path, format=format, quality=80)
+    os.replace(temp_path, path)
+
+def thumbnail_source(name: str) -> str | None:
+    '''
+    Returns the best stored image to build other thumbnail sizes from.
+    '''
+    for path in (locate(thumbnail_location(name)), locate(legacy_thumbnail_location(name))):
+        if os.path.exists(path):
+            return path
+    return None
+
+@metrics.timed("render_thumbnail_variant")
+def render_thumbnail_variant(source: str, width: int, format: str, output: str):
+    from PIL import Image
+    with Image.open(source) as image:
+        rendition = resize_to_width(image.convert("RGB"), width)
+        rendition.save(output, format=THUMBNAIL_FORMATS[format], quality=80)
+
+@metrics.timed("create_library_entry")
+def create_library_entry(bookData: Dict, database: Database = db) -> bool:
     """
     Creates or updates a library entry for a given book.
     Safely inserts data into the SQLite database.
     """
-    print(f"BookData: ", bookData)
+    logger.debug("Creating library entry", extra={"book": bookData})
     try:
-        with sqlite3.connect("library.db") as con:
-            cursor = con.cursor()
-
-            # Ensure table exists
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS books (
-                    id TEXT PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    author TEXT,
-                    file_type TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                );
-            """)
-
+        with database.transaction() as con:
             # Insert new book entry
-            cursor.execute("""
-                INSERT INTO books (id, title, author, file_type, user_id)
-                VALUES (?, ?, ?, ?, ?);
+            con.execute("""
+                INSERT INTO books (id, title, author, file_type, user_id, added_at, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?);
             """, (
                 bookData["id"],
                 bookData["title"],
                 bookData.get("author", None),
                 bookData["file_type"],
-                bookData["user_id"]
+                bookData["user_id"],
+                bookData.get("added_at", int(time.time())),
+                bookData.get("content_hash", None)
             ))
 
-            con.commit()
+            # Take a reference on the stored content
+            if bookData.get("content_hash"):
+                con.execute("""
+                    INSERT INTO blobs (hash, file_type, refcount) VALUES (?, ?, 1)
+                    ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+                """, (bookData["content_hash"], bookData["file_type"]))
+                # Content deleted but not yet swept is in use again
+                con.execute("DELETE FROM tombstones WHERE name = ?", (bookData["content_hash"],))
+
+            # Index the title and author for search. The body is added by the
+            # text job, or copied from a book with the same content and
+            # re-prefixed for this user.
+            prefix = search_prefix(bookData["user_id"])
+            con.execute("""
+                INSERT INTO book_search (book_id, user_id, title, author, body)
+                VALUES (?, ?, ?, ?, (
+                    SELECT replace(s.body, printf('u%08xx', s.user_id), ?) FROM books b JOIN book_search s ON s.book_id = b.id
+                    WHERE b.content_hash = ? AND s.body IS NOT NULL LIMIT 1
+                ))
+            """, (
+                bookData["id"], bookData["user_id"],
+                search_text(bookData["user_id"], bookData["title"]), search_text(bookData["user_id"], bookData.get("author", None)),
+                prefix, bookData.get("content_hash", None)
+            ))
+            database.after_commit(lambda: libraryCache.bump(bookData["user_id"]))
             return True
 
     except sqlite3.IntegrityError as e:
-        print(f"Error: {e}")
+        logger.warning("Library entry rejected", extra={"book_id": bookData["id"], "error": str(e)})
         raise
 
-    except Exception as e:
-        print(f"Database error: {e}")
+    except Exception:
+        logger.exception("Could not create library entry", extra={"book_id": bookData["id"]})
         raise
     
-def delete_library_entry(uuid: str) -> bool:
+def get_book(book_id: str, database: Database = db) -> Dict | None:
+    keys = ['id', 'title', 'author', 'file_type', 'user_id', 'content_hash', 'added_at',
+            'page_count', 'byte_size', 'language', 'published']
+    row = database.connection().execute(f"SELECT {', '.join(keys)} FROM books WHERE id = ?", (book_id,)).fetchone()
+    return dict(zip(keys, row)) if row else None
+
+def book_owners(book_id: str, database: Database = db) -> List[int]:
+    '''
+    Returns the users owning a book or another copy of the same content.
+    '''
+    cursor = database.connection().execute("""
+        SELECT DISTINCT user_id FROM books
+        WHERE id = ? OR content_hash = (SELECT content_hash FROM books WHERE id = ?)
+    """, (book_id, book_id))
+    return [row[0] for row in cursor.fetchall()]
+
+@metrics.timed("delete_library_entries")
+def delete_library_entries(book_ids: List[str], user_id: int | None = None, database: Database = db) -> List[str]:
+    '''
+    Deletes books in one transaction and returns the ids actually deleted.
+    With user_id set, books belonging to anyone else are skipped. Content
+    that loses its last reference gets a tombstone in the same transaction;
+    the files themselves are removed later by sweep_tombstones, so a crash
+    in between can't leave orphaned files behind.
+    '''
+    deleted = []
+    owners = set()
+    now = int(time.time())
+    with database.transaction() as con:
+        for book_id in book_ids:
+            row = con.execute("SELECT content_hash, user_id, file_type FROM books WHERE id = ?", (book_id,)).fetchone()
+            if row is None or (user_id is not None and row[1] != user_id):
+                continue
+            content_hash, owner, file_type = row
+            con.execute("DELETE FROM books WHERE id = ?", (book_id,))
+            con.execute("DELETE FROM book_search WHERE book_id = ?", (book_id,))
+            # Drop our reference on the stored content
+            if content_hash:
+                con.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (content_hash,))
+                gone = con.execute("DELETE FROM blobs WHERE hash = ? AND refcount <= 0", (content_hash,)).rowcount
+            else:
+                gone = 1
+            if gone:
+                con.execute(
+                    "INSERT OR IGNORE INTO tombstones (name, file_type, created_at) VALUES (?, ?, ?)",
+                    (content_hash or book_id, file_type, now)
+                )
+            deleted.append(book_id)
+            owners.add(owner)
+        for owner in owners:
+            database.after_commit(lambda owner=owner: libraryCache.bump(owner))
+    return deleted
+
+def delete_library_entry(uuid: str, database: Database = db) -> bool:
     try:
-        with sqlite3.connect('library.db') as con:
-            cursor = con.cursor()
-            cursor.execute(f"DELETE FROM books WHERE id = '{uuid}';")
-            con.commit()
-            return True
-    except Exception as e:
-        print(f'Error: {e}')
+        return bool(delete_library_entries([uuid], database=database))
+    except Exception:
+        logger.exception("Could not delete library entry", extra={"book_id": uuid})
         return False
-    
-def delete_library_file(uuid: str) -> bool:
-    flag = True
-    files = glob.glob(f'./books/{uuid}.*')
-    thumbnails = glob.glob(f'./thumbnails/{uuid}.*')
-    for file in files:
+
+def stored_files(name: str, file_type: str) -> List[str]:
+    '''
+    Every file kept on disk for a stored book: the book itself and its
+    thumbnails, in both the sharded and the flat layout.
+    '''
+    thumbnails = [thumbnail_location(name, size) for size in THUMBNAIL_SIZES]
+    sharded = [blob_location(name, file_type), legacy_thumbnail_location(name)] + thumbnails
+    return sharded + [flat_location(path) for path in sharded]
+
+@metrics.timed("sweep_tombstones")
+def sweep_tombstones(batch_size: int = 100, database: Database = db) -> int:
+    '''
+    Removes the files of deleted content, a batch at a time, along with its
+    cached thumbnail widths and reader pages. Content uploaded again since
+    it was deleted is left alone. Returns the number of tombstones cleared.
+    '''
+    cleared = 0
+    while True:
+        failed = False
+        doomed, names = [], []
+        with database.transaction() as con:
+            rows = con.execute("SELECT name, file_type FROM tombstones LIMIT ?", (batch_size,)).fetchall()
+            for name, file_type in rows:
+                if not con.execute("SELECT 1 FROM blobs WHERE hash = ?", (name,)).fetchone():
+                    # Renaming is cheap and moves the files out of the way of
+                    # an upload of the same content; they are unlinked after commit
+                    try:
+                        set_aside(stored_files(name, file_type), doomed)
+                    except OSError as e:
+                        # Leave the tombstone for the next sweep
+                        logger.warning("Could not remove stored files", extra={"name": name, "error": str(e)})
+                        failed = True
+                        continue
+                    names.append(name)
+                con.execute("DELETE FROM tombstones WHERE name = ?", (name,))
+                cleared += 1
+        remove_set_aside(doomed, names)
+        if failed or len(rows) < batch_size:
+            return cleared
+
+def remove_set_aside(paths: List[str], names: List[str]):
+    '''
+    Unlinks files moved by set_aside, outside any transaction, and drops the
+    cached thumbnail widths and reader pages of the content names.
+    '''
+    for path in paths:
         try:
-            os.remove(file)
-        except:
-            print(f"Error deleting file.")
-            flag = False
-    for thumbnail in thumbnails:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("Could not remove stored file", extra={"path": path, "error": str(e)})
+    prefixes = [f"{name}-" for name in names]
+    thumbnailCache.discard_prefixes(prefixes)
+    pages.pageCache.discard_prefixes(prefixes)
+
+def set_aside(paths: List[str], moved: List[str]):
+    '''
+    Renames the existing files among paths to hidden names in the same
+    directory, appending the new names to moved as it goes.
+    '''
+    token = uuid.uuid4().hex
+    for path in paths:
+        directory, file_name = os.path.split(path)
+        hidden = os.path.join(directory, f".deleted-{token}-{file_name}")
         try:
-            os.remove(thumbnail)
-        except:
-            print("Error deleting thumbnail.")
-            flag = False
-    return flag
-    
-def get_library_list(user_id: int) -> List[Dict]:
-    keys = ['id', 'title', 'author', 'file_type', "user_id"]
-    finalBookList = []
+            os.rename(path, hidden)
+        except FileNotFoundError:
+            continue
+        moved.append(hidden)
+
+def encode_cursor(sort_value, book_id: str) -> str:
+    raw = json.dumps([sort_value, book_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str) -> Tuple:
     try:
-        with sqlite3.connect('library.db') as con:
-            cursor = con.cursor()
-            cursor.execute("SELECT * FROM books WHERE user_id = ?;", (user_id,))
-            books = cursor.fetchall()
-            for book in books:
-                bookDict = dict(zip(keys, book))
-                finalBookList.append(bookDict)
-    except Exception as e:
-        print(f'Error: {e}') 
+        sort_value, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, book_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
-    return finalBookList
+@metrics.timed("get_library_page")
+def get_library_page(user_id: int, sort: str = "title", order: str = "asc",
+                     limit: int = LIBRARY_PAGE_SIZE, cursor: str | None = None,
+                     database: Database = db) -> Tuple[List[tuple], str | None]:
+    '''
+    Returns one page of a user's library using keyset pagination, plus the
+    cursor for the next page (None on the last page). Rows are
+    (id, title, author, file_type, added_at) tuples.
+    '''
+    if sort not in LIBRARY_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort key: {sort}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Invalid sort order: {order}")
+    limit = max(1, min(limit, LIBRARY_MAX_PAGE_SIZE))
 
-def edit_library_entry(id: str, data: dict):
+    sortKey = LIBRARY_SORT_KEYS[sort]
+    direction = "ASC" if order == "asc" else "DESC"
+    comparison = ">" if order == "asc" else "<"
+
+    sqlStatement = f"SELECT id, title, author, file_type, added_at, {sortKey} FROM books WHERE user_id = ?"
+    values_to_bind: tuple = (user_id,)
+    if cursor is not None:
+        sqlStatement += f" AND ({sortKey}, id) {comparison} (?, ?)"
+        values_to_bind += decode_cursor(cursor)
+    sqlStatement += f" ORDER BY {sortKey} {direction}, id {direction} LIMIT ?"
+    values_to_bind += (limit + 1,)
+
+    rows = database.connection().execute(sqlStatement, values_to_bind).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+    return [row[:5] for row in rows], next_cursor
+
+@metrics.timed("edit_library_entry")
+def edit_library_entry(id: str, data: dict, database: Database = db):
     editableColumns = ['title', 'author']
     finalData = {key: value for key, value in data.items() if key in editableColumns}
 
@@ -206,14 +604,128 @@ def edit_library_entry(id: str, data: dict):
     values_to_bind = tuple(finalData.values()) + (id,)
 
     try:
-        with sqlite3.connect('library.db') as con:
-            cursor = con.cursor()
-            cursor.execute(sqlStatement, values_to_bind)
+        with database.transaction() as con:
+            cursor = con.execute(sqlStatement, values_to_bind)
+            owner = con.execute("SELECT user_id FROM books WHERE id = ?", (id,)).fetchone()
+            if owner:
+                searchValues = tuple(search_text(owner[0], value) for value in finalData.values()) + (id,)
+                con.execute(f"UPDATE book_search SET {set_clause} WHERE book_id = ?", searchValues)
+                database.after_commit(lambda: libraryCache.bump(owner[0]))
         if cursor.rowcount == 0:
             return {"message": f"Book with ID '{id}' not found. No update performed."}
-        con.commit() 
         return {"message": "metadata updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
+def index_book_text(book_id: str, file_location: str):
+    '''
+    Background job: adds the extracted body text of a book to the search index.
+    '''
+    text = formats.handler_for_location(file_location).extract_text(file_location, SEARCH_MAX_TEXT)
+    with db.transaction() as con:
+        # Books sharing the same content share the extracted text, prefixed for each owner
+        rows = con.execute("""
+            SELECT book_id, user_id FROM book_search
+            WHERE book_id = ? OR book_id IN (
+                SELECT id FROM books WHERE content_hash = (SELECT content_hash FROM books WHERE id = ?)
+            )
+        """, (book_id, book_id)).fetchall()
+        bodies = {user_id: search_text(user_id, text) for user_id in {row[1] for row in rows}}
+        con.executemany("UPDATE book_search SET body = ? WHERE book_id = ?", [(bodies[user_id], id) for id, user_id in rows])
+
+def index_book_metadata(book_id: str, file_location: str):
+    '''
+    Background job: reads a stored book's metadata and fills it in on every
+    book with the same content in one update. The title and author are only
+    filled in if the user hasn't set them (the title is still the uploaded
+    file name). metadata_at is set even if reading fails, so the backfill
+    doesn't keep retrying a broken file.
+    '''
+    metadata = {"title": None, "author": None, "page_count": None, "language": None, "published": None}
+    error = None
+    try:
+        metadata.update(formats.handler_for_location(file_location).read_metadata(file_location))
+    except Exception as e:
+        error = e
+    metadata["byte_size"] = os.path.getsize(file_location) if os.path.exists(file_location) else None
+    metadata["metadata_at"] = int(time.time())
+    metadata["id"] = book_id
+
+    with db.transaction() as con:
+        rows = con.execute("""
+            UPDATE books SET
+                title = CASE WHEN :title IS NOT NULL AND title LIKE '%.' || file_type THEN :title ELSE title END,
+                author = IFNULL(author, :author),
+                page_count = :page_count,
+                byte_size = :byte_size,
+                language = :language,
+                published = :published,
+                metadata_at = :metadata_at
+            WHERE id = :id OR content_hash = (SELECT content_hash FROM books WHERE id = :id)
+            RETURNING title, author, id, user_id
+        """, metadata).fetchall()
+        con.executemany(
+            "UPDATE book_search SET title = ?, author = ? WHERE book_id = ?",
+            [(search_text(user_id, title), search_text(user_id, author), id) for title, author, id, user_id in rows]
+        )
+    if error is not None:
+        raise error
 
+def search_prefix(user_id: int) -> str:
+    # Fixed width, so the FTS prefix index can cover short prefixes of words
+    return f"u{user_id:08x}x"
+
+def search_text(user_id: int, text: str | None) -> str | None:
+    '''
+    Text as it is stored in book_search: every word carries its owner's
+    search prefix.
+    '''
+    if text is None:
+        return None
+    return SEARCH_WORD.sub(search_prefix(user_id) + r"\g<0>", text)
+
+def search_query(user_id: int, query: str) -> str | None:
+    '''
+    Turns free text into a safe FTS5 query over a user's books: every word
+    must match, and the last word matches as a prefix so results update
+    while typing.
+    '''
+    terms = SEARCH_WORD.findall(query)
+    if not terms:
+        return None
+    prefix = search_prefix(user_id)
+    phrases = [f'"{prefix}{term}"' for term in terms]
+    if len(terms[-1]) >= SEARCH_MIN_PREFIX:
+        phrases[-1] += "*"
+    return " ".join(phrases)
+
+@metrics.timed("search_library")
+def search_library(user_id: int, query: str, limit: int = 20, snippets: bool = True) -> List[Dict]:
+    '''
+    Searches a user's books by title, author and body text, best matches first.
+    '''
+    match = search_query(user_id, query)
+    if match is None:
+        return []
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+    snippet = "snippet(book_search_fts, -1, '<mark>', '</mark>', '…', 12)" if snippets else "NULL"
+    keys = ['id', 'title', 'author', 'snippet']
+    # The match only finds the user's own words; the user_id check is a
+    # backstop. Titles and authors come from books, without the prefixes.
+    cursor = db.connection().execute(f"""
+        SELECT s.book_id, b.title, b.author, {snippet}
+        FROM book_search_fts
+        JOIN book_search s ON s.rowid = book_search_fts.rowid
+        JOIN books b ON b.id = s.book_id
+        WHERE book_search_fts MATCH ? AND s.user_id = ?
+        ORDER BY bm25(book_search_fts, ?, ?, ?)
+        LIMIT ?
+    """, (match, user_id, *SEARCH_WEIGHTS, limit))
+    prefix = search_prefix(user_id)
+    results = []
+    for row in cursor.fetchall():
+        result = dict(zip(keys, row))
+        if result['snippet'] is not None:
+            result['snippet'] = result['snippet'].replace(prefix, "")
+        results.append(result)
+    return results
@@ -0,0 +1,40 @@
+import json
+import logging
+import os
+
+# Logging is configured once at startup from the environment:
+#   BOOKSHELF_LOG_LEVEL  - DEBUG, INFO, WARNING, ... (default WARNING)
+#   BOOKSHELF_LOG_FORMAT - "json" for one JSON object per line, anything else for plain text
+LOG_LEVEL = os.environ.get("BOOKSHELF_LOG_LEVEL", "WARNING").upper()
+LOG_FORMAT = os.environ.get("BOOKSHELF_LOG_FORMAT", "text").lower()
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = LOG_LEVEL, format: str = LOG_FORMAT):
+    handler = logging.StreamHandler()
+    if format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger = logging.getLogger("bookshelf")
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
@@ -0,0 +1,205 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+import threading
+import time
+
+# Prometheus metrics kept in process memory and served in the text
+# exposition format by /metrics. Recording a value is a dict lookup and a
+# few additions under a lock, cheap enough to leave on in production.
+# Values recorded inside the job worker processes stay in those processes,
+# so jobs are timed from the server side instead.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# SQLite statements mostly finish in well under a millisecond
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 1)
+
+REGISTRY: List["Metric"] = []
+# Called at every scrape, for values that are cheaper to read than to track
+COLLECTORS: List[Callable[[], List[str]]] = []
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+        if not self.labels:
+            # Reported as zero until first recorded, so rates work from the start
+            self._values[()] = 0
+        REGISTRY.append(self)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket (the last one is +Inf), then the sum
+        self._histograms: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            histograms = [(key, histogram[:]) for key, histogram in self._histograms.items()]
+        lines = []
+        names = self.labels + ("le",)
+        for key, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {histogram[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for collector in COLLECTORS:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+httpRequestSeconds = Histogram(
+    "bookshelf_http_request_duration_seconds", "Time to handle a request, by route template.",
+    ("method", "route", "status")
+)
+httpRequestsInFlight = Gauge("bookshelf_http_requests_in_flight", "Requests being handled right now.", ("method",))
+stageSeconds = Histogram("bookshelf_stage_seconds", "Time spent in each stage of library operations.", ("stage",))
+dbQuerySeconds = Histogram(
+    "bookshelf_db_query_duration_seconds", "Time to execute a SQLite statement, by its first keyword.",
+    ("statement",), QUERY_BUCKETS
+)
+dbLockWaitSeconds = Histogram(
+    "bookshelf_db_lock_wait_seconds", "Time spent waiting for the SQLite write lock.", (), QUERY_BUCKETS
+)
+dbLockWaits = Counter(
+    "bookshelf_db_lock_waits_total", "Write transactions that had to wait on busy_timeout retries for the lock."
+)
+dbLockTimeouts = Counter(
+    "bookshelf_db_lock_timeouts_total", "Write transactions that gave up after busy_timeout."
+)
+dbTransactionSeconds = Histogram(
+    "bookshelf_db_transaction_duration_seconds", "Time the SQLite write lock was held per transaction.", (), QUERY_BUCKETS
+)
+jobSeconds = Histogram(
+    "bookshelf_job_duration_seconds", "Time from dispatching a background job to its completion.",
+    ("kind", "status")
+)
+jobFailures = Counter("bookshelf_job_failures_total", "Background jobs that failed, e.g. thumbnails that didn't render.", ("kind",))
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    '''
+    Times the block into bookshelf_stage_seconds.
+    '''
+    with stageSeconds.time(stage):
+        yield
+
+def timed(stage: str):
+    '''
+    Decorator timing every call of a function into bookshelf_stage_seconds.
+    '''
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stageSeconds.time(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording request latency by route template, and the
+    number of requests in flight. Routes are labelled by their template
+    (/library/{user_id}), so label cardinality stays bounded.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        httpRequestsInFlight.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            httpRequestSeconds.observe(
+                time.perf_counter() - start, method, getattr(route, "path", "unmatched"), status
+            )
+            httpRequestsInFlight.dec(method)
@@ -0,0 +1,300 @@
+from typing import Callable, List, Tuple
+import logging
+import re
+import sqlite3
+from database import Database, db
+
+# Versioned schema migrations. The schema version lives in SQLite's
+# user_version pragma; migrate() runs every migration above it, in order,
+# once at startup. Databases created before migrations existed start at
+# version 0, so each migration checks for what older versions of the code
+# may already have created instead of assuming a clean slate.
+#
+# To change the schema, append a new migration. Never edit one that has shipped.
+
+logger = logging.getLogger("bookshelf.migrations")
+
+MIGRATIONS: List[Tuple[str, Callable[[sqlite3.Connection], None]]] = []
+
+def migration(description: str):
+    '''
+    Decorator appending a migration. Its version is its position in MIGRATIONS, from 1.
+    '''
+    def register(function: Callable[[sqlite3.Connection], None]):
+        MIGRATIONS.append((description, function))
+        return function
+    return register
+
+def columns(con: sqlite3.Connection, table: str) -> List[str]:
+    # table_xinfo, unlike table_info, also lists generated columns
+    return [row[1] for row in con.execute(f"PRAGMA table_xinfo({table})")]
+
+def add_column(con: sqlite3.Connection, table: str, column: str, definition: str):
+    if column not in columns(con, table):
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+@migration("Create users, refresh_tokens and books")
+def initial_schema(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            jti TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            revoked INTEGER DEFAULT 0
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS books (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            author TEXT,
+            file_type TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+
+@migration("Add added_at and author_sort to books, with covering indexes for the library listing")
+def library_listing(con: sqlite3.Connection):
+    add_column(con, "books", "added_at", "INTEGER NOT NULL DEFAULT 0")
+    add_column(con, "books", "author_sort", "TEXT GENERATED ALWAYS AS (IFNULL(author, '')) VIRTUAL")
+    # These lead with user_id, so they also serve plain lookups of a user's books
+    con.execute("CREATE INDEX IF NOT EXISTS idx_books_user_title ON books (user_id, title, id, author, file_type, added_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_books_user_author ON books (user_id, author_sort, id, title, author, file_type, added_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_books_user_added ON books (user_id, added_at, id, title, author, file_type)")
+
+@migration("Create the background jobs table")
+def jobs_table(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            file_location TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
+        )
+    """)
+
+@migration("Content-addressed storage: blobs table and books.content_hash")
+def blob_store(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            file_type TEXT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    add_column(con, "books", "content_hash", "TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_books_content_hash ON books (content_hash)")
+
+@migration("Full-text search tables and triggers")
+def search_index(con: sqlite3.Connection):
+    # book_search holds the searchable text and book_search_fts is an
+    # external-content FTS5 index over it, kept in sync by triggers.
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS book_search (
+            rowid INTEGER PRIMARY KEY,
+            book_id TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            author TEXT,
+            body TEXT
+        )
+    """)
+    con.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS book_search_fts USING fts5(
+            title, author, body,
+            content='book_search', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_search_ai AFTER INSERT ON book_search BEGIN
+            INSERT INTO book_search_fts (rowid, title, author, body) VALUES (new.rowid, new.title, new.author, new.body);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_search_ad AFTER DELETE ON book_search BEGIN
+            INSERT INTO book_search_fts (book_search_fts, rowid, title, author, body) VALUES ('delete', old.rowid, old.title, old.author, old.body);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_search_au AFTER UPDATE ON book_search BEGIN
+            INSERT INTO book_search_fts (book_search_fts, rowid, title, author, body) VALUES ('delete', old.rowid, old.title, old.author, old.body);
+            INSERT INTO book_search_fts (rowid, title, author, body) VALUES (new.rowid, new.title, new.author, new.body);
+        END
+    """)
+    # Index books added before search existed; their body text is not extracted
+    con.execute("""
+        INSERT INTO book_search (book_id, user_id, title, author)
+        SELECT id, user_id, title, author FROM books
+        WHERE id NOT IN (SELECT book_id FROM book_search)
+    """)
+
+@migration("Index refresh tokens for purging and logout-all")
+def refresh_token_indexes(con: sqlite3.Connection):
+    con.execute("CREATE INDEX IF NOT EXISTS idx_refresh_tokens_username ON refresh_tokens (username, revoked)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires_at ON refresh_tokens (expires_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_refresh_tokens_revoked ON refresh_tokens (revoked) WHERE revoked = 1")
+
+@migration("Create the bulk import tables")
+def import_tables(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS imports (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS import_items (
+            import_id TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            book_id TEXT,
+            error TEXT,
+            PRIMARY KEY (import_id, entry),
+            FOREIGN KEY (import_id) REFERENCES imports(id) ON DELETE CASCADE
+        )
+    """)
+
+@migration("Add the columns filled in by the metadata job")
+def metadata_columns(con: sqlite3.Connection):
+    add_column(con, "books", "page_count", "INTEGER")
+    add_column(con, "books", "byte_size", "INTEGER")
+    add_column(con, "books", "language", "TEXT")
+    add_column(con, "books", "published", "TEXT")
+    add_column(con, "books", "metadata_at", "INTEGER")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_books_metadata_pending ON books (content_hash) WHERE metadata_at IS NULL")
+
+@migration("Index foreign keys and job status, and drop rows orphaned while foreign keys were off")
+def foreign_key_indexes(con: sqlite3.Connection):
+    # Without an index on the child column every parent delete scans the child table
+    con.execute("CREATE INDEX IF NOT EXISTS idx_jobs_book_id ON jobs (book_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_jobs_unfinished ON jobs (status) WHERE status IN ('pending', 'running')")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_imports_user_id ON imports (user_id)")
+    con.execute("DELETE FROM jobs WHERE book_id NOT IN (SELECT id FROM books)")
+    con.execute("DELETE FROM import_items WHERE import_id NOT IN (SELECT id FROM imports)")
+    con.execute("DELETE FROM imports WHERE user_id NOT IN (SELECT id FROM users)")
+    con.execute("DELETE FROM book_search WHERE book_id NOT IN (SELECT id FROM books)")
+
+@migration("Tombstones for stored files waiting to be removed")
+def tombstones(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS tombstones (
+            name TEXT PRIMARY KEY,
+            file_type TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+@migration("Create the resumable upload tables")
+def upload_sessions(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            range_start INTEGER NOT NULL,
+            range_end INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, range_start, range_end),
+            FOREIGN KEY (upload_id) REFERENCES upload_sessions(id) ON DELETE CASCADE
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_user_id ON upload_sessions (user_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at ON upload_sessions (updated_at)")
+
+@migration("Import leases, so one process at a time works on an import")
+def import_leases(con: sqlite3.Connection):
+    add_column(con, "imports", "owner", "TEXT")
+    add_column(con, "imports", "heartbeat_at", "INTEGER")
+
+@migration("Prefix search words with their owner, so a match reads one user's words")
+def search_owner_prefix(con: sqlite3.Connection):
+    # book_search keeps every word as "u" + 8 hex digits of the user id + "x"
+    # + the word, and titles and authors are displayed from books. The
+    # triggers are dropped while the rows are rewritten, and the index is
+    # rebuilt with its prefix indexes moved past the 10 character owner prefix.
+    word = re.compile(r"[^\W_]+")
+    for trigger in ("book_search_ai", "book_search_ad", "book_search_au"):
+        con.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    con.execute("DROP TABLE IF EXISTS book_search_fts")
+    rows = con.execute("SELECT rowid, user_id, title, author, body FROM book_search").fetchall()
+    for rowid, user_id, *texts in rows:
+        replacement = f"u{user_id:08x}x" + r"\g<0>"
+        con.execute(
+            "UPDATE book_search SET title = ?, author = ?, body = ? WHERE rowid = ?",
+            (*(None if text is None else word.sub(replacement, text) for text in texts), rowid)
+        )
+    con.execute("""
+        CREATE VIRTUAL TABLE book_search_fts USING fts5(
+            title, author, body,
+            content='book_search', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2', prefix='12 13'
+        )
+    """)
+    con.execute("""
+        CREATE TRIGGER book_search_ai AFTER INSERT ON book_search BEGIN
+            INSERT INTO book_search_fts (rowid, title, author, body) VALUES (new.rowid, new.title, new.author, new.body);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER book_search_ad AFTER DELETE ON book_search BEGIN
+            INSERT INTO book_search_fts (book_search_fts, rowid, title, author, body) VALUES ('delete', old.rowid, old.title, old.author, old.body);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER book_search_au AFTER UPDATE ON book_search BEGIN
+            INSERT INTO book_search_fts (book_search_fts, rowid, title, author, body) VALUES ('delete', old.rowid, old.title, old.author, old.body);
+            INSERT INTO book_search_fts (rowid, title, author, body) VALUES (new.rowid, new.title, new.author, new.body);
+        END
+    """)
+    con.execute("INSERT INTO book_search_fts (book_search_fts) VALUES ('rebuild')")
+
+
+def schema_version(database: Database = db) -> int:
+    return database.connection().execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(database: Database = db) -> int:
+    '''
+    Brings the database schema up to date. Each migration runs in its own
+    transaction together with the version bump, so a failed migration
+    leaves the database at the last good version. Safe to call from several
+    processes at once: the version is re-read under the write lock.
+    Returns the schema version.
+    '''
+    for version, (description, function) in enumerate(MIGRATIONS, start=1):
+        if schema_version(database) >= version:
+            continue
+        with database.transaction() as con:
+            if con.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            logger.info("Applying migration %d: %s", version, description)
+            function(con)
+            con.execute(f"PRAGMA user_version = {version}")
+    return schema_version(database)
@@ -0,0 +1,116 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict
+import logging
+import multiprocessing
+import os
+import threading
+import formats
+import metrics
+from filecache import DiskCache
+
+# On-demand page rendering for the in-browser reader. Pages are rendered
+# one at a time by poppler in a small process pool of their own, so reading
+# never waits behind thumbnail jobs, and kept in an LRU disk cache keyed by
+# stored file, page and width. Serving page N also queues the next few
+# pages, so turning the page is usually a cache hit. Time to first page
+# depends on the page, not on the size of the book.
+
+PAGE_RENDER_WORKERS = int(os.environ.get("PAGE_RENDER_WORKERS", 2))
+# Pages rendered ahead of the one requested
+PAGE_PREFETCH = int(os.environ.get("PAGE_PREFETCH", 3))
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", 512 * 1024 * 1024))
+# Widths are rounded up to a multiple of PAGE_WIDTH_STEP so nearby screen
+# sizes share cache entries
+PAGE_MIN_WIDTH = 200
+PAGE_MAX_WIDTH = 2400
+PAGE_WIDTH_STEP = 100
+
+logger = logging.getLogger("bookshelf.pages")
+
+pageCache = DiskCache('./pages', PAGE_CACHE_BYTES)
+
+_pool: ProcessPoolExecutor | None = None
+# Prefetches only wait on the process pool, so a thread each is plenty
+_prefetcher: ThreadPoolExecutor | None = None
+# Renders in progress, so concurrent requests for a page share one render
+_inflight: Dict[str, Future] = {}
+_lock = threading.Lock()
+
+
+def start(workers: int = PAGE_RENDER_WORKERS):
+    global _pool, _prefetcher
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        _prefetcher = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="page-prefetch")
+
+def stop():
+    global _pool, _prefetcher
+    if _pool is not None:
+        _prefetcher.shutdown(wait=False, cancel_futures=True)
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _prefetcher = None
+
+
+def page_width(width: int) -> int:
+    width = max(PAGE_MIN_WIDTH, min(width, PAGE_MAX_WIDTH))
+    return -(-width // PAGE_WIDTH_STEP) * PAGE_WIDTH_STEP
+
+def page_key(name: str, page: int, width: int) -> str:
+    return f"{name}-{page}-{width}.webp"
+
+def render_page_file(file_location: str, page: int, width: int, output: str):
+    '''
+    Entry point inside the worker process.
+    '''
+    image = formats.handler_for_location(file_location).render_page(file_location, page, width)
+    image.save(output, format="WEBP", quality=80)
+
+
+def render_page(name: str, file_location: str, page: int, width: int) -> str:
+    '''
+    Returns the path of the rendered page, rendering it in the worker pool
+    unless it is cached or already being rendered.
+    '''
+    key = page_key(name, page, width)
+    with _lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        with metrics.span("render_page"):
+            path = pageCache.get_or_create(
+                key, lambda output: _pool.submit(render_page_file, file_location, page, width, output).result()
+            )
+        future.set_result(path)
+        return path
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+def _prefetch_page(name: str, file_location: str, page: int, width: int):
+    try:
+        render_page(name, file_location, page, width)
+    except IndexError:
+        pass
+    except Exception:
+        logger.exception("Page prefetch failed", extra={"name": name, "page": page})
+
+def prefetch(name: str, file_location: str, page: int, width: int, page_count: int | None):
+    '''
+    Queues the PAGE_PREFETCH pages after page that aren't cached or rendering yet.
+    '''
+    last = page + PAGE_PREFETCH if page_count is None else min(page + PAGE_PREFETCH, page_count)
+    for next_page in range(page + 1, last + 1):
+        key = page_key(name, next_page, width)
+        with _lock:
+            if key in _inflight:
+                continue
+        if key not in pageCache:
+            _prefetcher.submit(_prefetch_page, name, file_location, next_page, width)
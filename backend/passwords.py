@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import asyncio
+import multiprocessing
+import os
+from fastapi import HTTPException
+
+# bcrypt is deliberately slow (~250ms per call at cost 12), so hashing runs
+# in its own small process pool instead of the request threadpool. Requests
+# beyond HASH_QUEUE_LIMIT get a 429 rather than queueing behind each other.
+# Use scripts/bcrypt_benchmark.py to pick BCRYPT_ROUNDS for your hardware.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", HASH_WORKERS * 4))
+
+
+@lru_cache(maxsize=1)
+def password_context():
+    '''
+    The passlib context, built on first use. Hashing happens in the pool's
+    worker processes, so the API process itself rarely needs passlib.
+    '''
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+def verify_password(plain: str, hash: str):
+    if not isinstance(plain, str):
+        plain = str(plain)
+    return password_context().verify(plain[:72], hash)
+
+def get_password_hash(password: str):
+    if not isinstance(password, str):
+        password = str(password)
+    return password_context().hash(password[:72])
+
+
+class HashingPool:
+    '''
+    Runs password hashing in a dedicated process pool with a bound on the
+    number of calls waiting or running at once.
+    '''
+    def __init__(self, workers: int = HASH_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.workers = max(1, workers)
+        self.queue_limit = max(1, queue_limit)
+        self.in_flight = 0
+        self._pool: ProcessPoolExecutor | None = None
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn, *args):
+        # Only touched from the event loop, so the counter needs no lock.
+        if self.in_flight >= self.queue_limit:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many sign-in requests, please try again shortly.",
+                headers={"Retry-After": "1"}
+            )
+        self.start()
+        self.in_flight += 1
+        try:
+            return await asyncio.wrap_future(self._pool.submit(fn, *args))
+        finally:
+            self.in_flight -= 1
+
+
+hashingPool = HashingPool()
+
+async def verify_password_async(plain: str, hash: str) -> bool:
+    return await hashingPool.run(verify_password, plain, hash)
+
+async def get_password_hash_async(password: str) -> str:
+    return await hashingPool.run(get_password_hash, password)
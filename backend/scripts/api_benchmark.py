@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# This script load-tests the API in-process: it seeds a scratch library with synthetic users and books,
+# then drives login, refresh, upload, library, edit and delete requests at a fixed concurrency through
+# an ASGI client, and reports latency percentiles, throughput and peak memory for each.
+# Run this script from the 'backend' folder using the command:
+#   python scripts/api_benchmark.py [--users N] [--books N] [--operations N] [--concurrency N] [--output results.json] [--baseline baseline.json]
+# Everything runs in a temporary directory, never against the real library.db. Save a run with --output and
+# pass it to a later run as --baseline to compare; the run fails if a scenario regressed by more than --tolerance.
+# Login time is mostly bcrypt; set BCRYPT_ROUNDS to match production, or lower it to focus on the rest.
+# Logins beyond HASH_QUEUE_LIMIT are turned away with 429, which shows up in the errors column.
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+SCENARIOS = ["login", "refresh", "upload", "library", "edit", "delete"]
+PASSWORD = "benchmark-password"
+
+
+def make_pdf(index: int) -> bytes:
+    '''
+    A small one-page PDF, different for every index.
+    '''
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", (400, 600), "white")
+    ImageDraw.Draw(image).text((40, 40), f"Benchmark book {index}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PDF")
+    return buffer.getvalue()
+
+
+def seed(users: int, books: int, rng: random.Random) -> dict:
+    '''
+    Fills the scratch database with users and books directly, bypassing the
+    API so seeding stays fast at any size. Every user shares one password hash.
+    Returns the user ids and, per user, the seeded book ids.
+    '''
+    import librarytools
+    from database import db
+    from passwords import get_password_hash
+
+    hashed = get_password_hash(PASSWORD)
+    words = ["river", "glass", "winter", "atlas", "ember", "harbor", "quiet", "orbit", "lantern", "meadow"]
+    with db.transaction() as con:
+        con.executemany(
+            "INSERT INTO users (username, password) VALUES (?, ?)",
+            [(f"user{index}", hashed) for index in range(users)]
+        )
+        userIds = [row[0] for row in con.execute("SELECT id FROM users ORDER BY id")]
+        booksByUser = {user_id: [] for user_id in userIds}
+        rows = []
+        for index in range(books):
+            user_id = userIds[index % users]
+            book_id = librarytools.generate_unique_id()
+            title = " ".join(rng.choice(words) for _ in range(3)).title()
+            author = None if index % 5 == 0 else f"{rng.choice(words).title()} {rng.choice(words).title()}"
+            rows.append((book_id, title, author, "pdf", user_id, 1_600_000_000 + index, 1_600_000_000 + index))
+            booksByUser[user_id].append(book_id)
+        # Seeded books have no files; metadata_at keeps the metadata backfill off them
+        con.executemany(
+            "INSERT INTO books (id, title, author, file_type, user_id, added_at, metadata_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        con.executemany(
+            "INSERT INTO book_search (book_id, user_id, title, author) VALUES (?, ?, ?, ?)",
+            [(book_id, user_id, librarytools.search_text(user_id, title), librarytools.search_text(user_id, author))
+             for book_id, title, author, _, user_id, *_ in rows]
+        )
+    return {"users": userIds, "books": booksByUser}
+
+
+def percentile(sortedValues: list, fraction: float) -> float:
+    if not sortedValues:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def run_scenario(operations: int, concurrency: int, request) -> dict:
+    '''
+    Calls request(index) operations times, concurrency at a time, and
+    summarizes the latencies. request returns the response status code and
+    whether the request did what it should.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+    errors = 0
+
+    async def run(index: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status, ok = await request(index)
+            except Exception as e:
+                status, ok = type(e).__name__, False
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(index) for index in range(operations)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "operations": operations,
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": elapsed,
+        "throughput": operations / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def benchmark(args, seeded: dict, rng: random.Random) -> dict:
+    import httpx
+    import auth
+    import jobs
+    import server
+
+    userIds = seeded["users"]
+    usernames = {user_id: f"user{index}" for index, user_id in enumerate(userIds)}
+    # Each edit and delete touches its own book, spread over the users
+    bookPool = [(user_id, book_id) for user_id, books in seeded["books"].items() for book_id in books]
+    rng.shuffle(bookPool)
+    editBooks = bookPool[:args.operations]
+    deleteBooks = bookPool[args.operations:args.operations * 2]
+    pdfs = [make_pdf(index) for index in range(args.operations)]
+
+    results = {}
+    app = server.create_app()
+    async with server.lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            # Tokens are made outside the timed runs so each scenario measures one endpoint
+            headers = {
+                user_id: {"Authorization": f"Bearer {auth.create_access_token({'sub': str(user_id), 'username': name})}"}
+                for user_id, name in usernames.items()
+            }
+            refreshTokens = []
+            # Starts the password hashing workers, so the first timed logins don't pay for it
+            await client.post("/auth/login", data={"username": usernames[userIds[0]], "password": PASSWORD})
+
+            async def login(index: int):
+                name = usernames[userIds[index % len(userIds)]]
+                response = await client.post("/auth/login", data={"username": name, "password": PASSWORD})
+                return response.status_code, response.status_code == 200
+
+            async def refresh(index: int):
+                response = await client.post("/auth/refresh", json={"refresh_token": refreshTokens[index]})
+                return response.status_code, response.status_code == 200
+
+            async def upload(index: int):
+                user_id = userIds[index % len(userIds)]
+                files = {"file": (f"benchmark-{index}.pdf", pdfs[index], "application/pdf")}
+                response = await client.post("/upload", files=files, headers=headers[user_id])
+                return response.status_code, response.status_code == 200
+
+            async def library(index: int):
+                user_id = userIds[index % len(userIds)]
+                params = {"sort": rng.choice(["title", "author", "added"]), "order": rng.choice(["asc", "desc"])}
+                response = await client.get(f"/library/{user_id}", params=params)
+                return response.status_code, response.status_code == 200
+
+            async def edit(index: int):
+                _, book_id = editBooks[index % len(editBooks)]
+                response = await client.put(f"/edit/{book_id}", json={"title": f"Edited {index}"})
+                return response.status_code, response.status_code == 200
+
+            async def delete(index: int):
+                _, book_id = deleteBooks[index % len(deleteBooks)]
+                response = await client.delete(f"/delete/{book_id}")
+                return response.status_code, response.status_code == 200 and response.json()["message"].startswith("Success")
+
+            requests = {"login": login, "refresh": refresh, "upload": upload,
+                        "library": library, "edit": edit, "delete": delete}
+            print(f"  {'scenario':<10} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'peak MB':>8}")
+            for name in args.scenarios:
+                if name == "refresh":
+                    # Made just before use, since refresh tokens are short-lived
+                    refreshTokens[:] = [
+                        auth.create_refresh_token({"sub": str(userIds[index % len(userIds)]), "username": usernames[userIds[index % len(userIds)]]})
+                        for index in range(args.operations)
+                    ]
+                result = await run_scenario(args.operations, args.concurrency, requests[name])
+                results[name] = result
+                print(f"  {name:<10} {result['throughput']:>9.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                      f"{result['p99_ms']:>9.2f} {result['errors']:>7} {result['peak_rss_mb']:>8.1f}")
+
+        # Let the thumbnail, text and metadata jobs from the uploads finish before shutting down
+        start = time.perf_counter()
+        while await asyncio.to_thread(jobs.jobTable.unfinished_count):
+            await asyncio.sleep(0.1)
+        print(f"Background jobs drained in {time.perf_counter() - start:.1f}s")
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    '''
+    Prints each scenario's change from the baseline run. Returns False if
+    any throughput dropped, or p95 latency grew, by more than tolerance.
+    '''
+    passed = True
+    print(f"\n  {'vs baseline':<10} {'ops/s':>9} {'p95':>9}")
+    for name, result in results.items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        throughput = result["throughput"] / before["throughput"] - 1
+        p95 = result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        regressed = throughput < -tolerance or p95 > tolerance
+        passed = passed and not regressed
+        print(f"  {name:<10} {throughput:>+9.1%} {p95:>+9.1%}{'  REGRESSED' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process load test of the bookshelf API.")
+    parser.add_argument("--users", type=int, default=20, help="users to seed")
+    parser.add_argument("--books", type=int, default=5000, help="books to seed, spread over the users")
+    parser.add_argument("--operations", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS, help="scenarios to run, in order")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic library")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+    if args.books < args.operations * 2:
+        parser.error("--books must be at least twice --operations, so edits and deletes each get their own books")
+
+    # Resolved before moving into the scratch directory
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as scratch:
+        # The server finds its database through the environment and its files relative to the working directory
+        os.environ["BOOKSHELF_DB_PATH"] = os.path.join(scratch, "library.db")
+        os.chdir(scratch)
+        import migrations
+        from database import db
+        migrations.migrate()
+
+        start = time.perf_counter()
+        seeded = seed(args.users, args.books, rng)
+        print(f"Seeded {args.users} users and {args.books} books in {time.perf_counter() - start:.1f}s")
+        results = asyncio.run(benchmark(args, seeded, rng))
+        db.close()
+
+    report = {
+        "created_at": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: getattr(args, key) for key in ("users", "books", "operations", "concurrency", "seed")},
+        "scenarios": results,
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {output}")
+    if baseline is not None and baseline["config"] != report["config"]:
+        print(f"Note: the baseline ran with {baseline['config']}")
+    if baseline is not None and not compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# This script times bcrypt hashing and verification at a range of cost factors,
+# to help pick BCRYPT_ROUNDS for the machine the backend runs on.
+# Run this script from the 'backend' folder using the command: python scripts/bcrypt_benchmark.py [min_rounds] [max_rounds]
+# Aim for the highest cost that keeps a single verify around 250ms or less; login
+# throughput per hashing worker is roughly 1 / (verify time).
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from passlib.context import CryptContext
+
+
+def time_call(fn, *args, repeat: int = 5) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    min_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    max_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+
+    print(f"{'rounds':>6} {'hash ms':>10} {'verify ms':>10} {'logins/s/worker':>16}")
+    for rounds in range(min_rounds, max_rounds + 1):
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        hashed = context.hash("benchmark-password")
+        hash_time = time_call(context.hash, "benchmark-password")
+        verify_time = time_call(context.verify, "benchmark-password", hashed)
+        print(f"{rounds:>6} {hash_time * 1000:>10.1f} {verify_time * 1000:>10.1f} {1 / verify_time:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+
+# This script imports a directory or zip archive of books into a user's library.
+# Run this script from the 'backend' folder using the command:
+#   python scripts/bulk_import.py <directory or zip> --user <username> [--workers N]
+# An interrupted import can be picked up again with: python scripts/bulk_import.py --resume <import id>
+# An import is worked on by one process at a time; the server leaves imports this script is running,
+# or left interrupted, alone.
+# Thumbnails and search text are generated before the script exits.
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import bulkimport
+import jobs
+import migrations
+from librarytools import UserTable
+
+
+def print_progress(counts: dict):
+    finished = counts["done"] + counts["failed"]
+    print(f"\r{finished}/{counts['total']} imported, {counts['failed']} failed", end="", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import books from a directory or zip archive.")
+    parser.add_argument("source", nargs="?", help="directory or zip archive of books")
+    parser.add_argument("--user", help="username to import the books for")
+    parser.add_argument("--workers", type=int, default=bulkimport.IMPORT_WORKERS, help="number of worker processes")
+    parser.add_argument("--resume", metavar="IMPORT_ID", help="resume an interrupted import")
+    args = parser.parse_args()
+
+    migrations.migrate()
+    if args.resume:
+        import_id = args.resume
+        if bulkimport.importTable.get_import(import_id) is None:
+            parser.error(f"no import with id {import_id}")
+    else:
+        if not args.source or not args.user:
+            parser.error("a source and --user are required unless resuming")
+        if not os.path.exists(args.source):
+            parser.error(f"{args.source} does not exist")
+        user = UserTable().usernameCheck(args.user)
+        if user is None:
+            parser.error(f"no user named {args.user}")
+        import_id = bulkimport.importTable.add_import(user[0], os.path.abspath(args.source))
+    print(f"Import {import_id}")
+
+    jobs.start(args.workers, resume=False)
+    try:
+        report = bulkimport.run_import(import_id, args.workers, progress=print_progress)
+    except KeyboardInterrupt:
+        print(f"\nInterrupted; resume with: python scripts/bulk_import.py --resume {import_id}")
+        jobs.stop()
+        return
+    except bulkimport.ImportInUse:
+        print(f"Import {import_id} is being run by another process.")
+        jobs.stop()
+        sys.exit(1)
+    print("\nGenerating thumbnails...")
+    jobs.stop(wait=True)
+
+    print(f"Import {report['status']}: {report['done']} books added, {report['failed']} failed.")
+    for failure in report["failures"]:
+        print(f"  {failure['entry']}: {failure['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+
+# This script moves books and thumbnails from the old flat layout (./books/<name>.pdf)
+# into the sharded layout (./books/ab/cd/<name>.pdf).
+# Run this script from the 'backend' folder using the command:
+#   python scripts/shard_storage.py [--batch N] [--dry-run]
+# It is safe to run while the server is up: the server finds files in either layout, and
+# files are moved under the database write lock so uploads and deletes never see a half-moved file.
+# Running it again after an interruption carries on where it stopped.
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import librarytools
+from database import db
+
+DIRECTORIES = ['./books', './thumbnails']
+
+
+def flat_files(directory: str):
+    '''
+    Yields the files still in the top level of directory, skipping
+    uploads and renders in progress.
+    '''
+    if not os.path.isdir(directory):
+        return
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.part'):
+            yield entry.path
+
+
+def move_batch(paths: list, dry_run: bool) -> int:
+    moved = 0
+    with db.transaction():
+        for path in paths:
+            directory, file_name = os.path.split(path)
+            destination = librarytools.shard(directory, file_name)
+            if dry_run:
+                print(f"{path} -> {destination}")
+            elif not os.path.exists(path):
+                # Deleted since it was listed
+                continue
+            elif os.path.exists(destination):
+                # Uploaded or rendered again since; the copies have the same name, so they match
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(path, destination)
+            moved += 1
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move stored books and thumbnails into the sharded layout.")
+    parser.add_argument("--batch", type=int, default=500, help="files moved per database lock")
+    parser.add_argument("--dry-run", action="store_true", help="print the moves without making them")
+    args = parser.parse_args()
+
+    for directory in DIRECTORIES:
+        moved = 0
+        batch = []
+        # Listed up front: moving entries out of a directory while scanning it can skip some
+        for path in list(flat_files(directory)):
+            batch.append(path)
+            if len(batch) >= args.batch:
+                moved += move_batch(batch, args.dry_run)
+                batch = []
+                print(f"\r{directory}: {moved} moved", end="", flush=True)
+        moved += move_batch(batch, args.dry_run)
+        print(f"\r{directory}: {moved} moved")
+
+
+if __name__ == "__main__":
+    main()
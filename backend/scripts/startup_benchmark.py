@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# This script measures how long a fresh API process takes to come up and how much memory it holds once
+# it has: importing server, building the app with create_app() and running startup(). Each run is a new
+# interpreter, so nothing is already imported or cached.
+# Run this script from the 'backend' folder using the command:
+#   python scripts/startup_benchmark.py [--runs N] [--output results.json] [--baseline baseline.json]
+# The run fails if the median import time or RSS is over budget, if any of LAZY_MODULES was loaded by
+# importing server, or (with --baseline) if a phase regressed by more than --tolerance.
+# --top N lists the slowest imports, from python -X importtime, to show where the time goes.
+
+BACKEND = Path(__file__).parent.parent
+
+# Heavy dependencies that must only load on first use, not when the server is imported
+LAZY_MODULES = ["PIL", "magic", "pdf2image", "passlib", "jose", "requests"]
+# Medians over the runs; what a worker under the autoscaler is allowed to cost
+IMPORT_BUDGET_MS = 1000
+RSS_BUDGET_MB = 80
+
+PHASES = ["import", "create_app", "startup"]
+
+# Runs in the child process; prints one JSON line of timings
+CHILD = '''
+import asyncio, json, resource, sys, time
+sys.path.insert(0, {backend!r})
+
+def rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+result = {{"rss_mb": {{"interpreter": rss_mb()}}}}
+start = time.perf_counter()
+import server
+result["import_ms"] = (time.perf_counter() - start) * 1000
+result["rss_mb"]["import"] = rss_mb()
+result["eager"] = [name for name in {lazy!r} if name in sys.modules]
+
+start = time.perf_counter()
+app = server.create_app()
+result["create_app_ms"] = (time.perf_counter() - start) * 1000
+result["rss_mb"]["create_app"] = rss_mb()
+
+async def lifecycle():
+    start = time.perf_counter()
+    await server.startup()
+    result["startup_ms"] = (time.perf_counter() - start) * 1000
+    result["rss_mb"]["startup"] = rss_mb()
+    await server.shutdown()
+
+asyncio.run(lifecycle())
+result["modules"] = len(sys.modules)
+print(json.dumps(result))
+'''
+
+
+def run_once(scratch: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    # A scratch database and working directory, so startup() never touches the real library
+    env = dict(os.environ, BOOKSHELF_DB_PATH=os.path.join(scratch, "library.db"))
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD.format(backend=str(BACKEND.resolve()), lazy=LAZY_MODULES)]
+    completed = subprocess.run(command, cwd=scratch, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.exit(f"Startup run failed:\n{completed.stderr}")
+    return completed
+
+
+def slowest_imports(stderr: str, top: int) -> list:
+    '''
+    The top-level imports (as seen from server) with the largest cumulative
+    time, from -X importtime output.
+    '''
+    imports, children = [], []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nesting is shown by indenting two spaces a level, and a module is
+        # listed after everything it imported
+        name = name[1:]
+        if not name.startswith(" "):
+            if name == "server":
+                imports = children
+            children = []
+        elif not name.startswith("   "):
+            children.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def summarize(runs: list) -> dict:
+    last = runs[-1]
+    summary = {f"{phase}_ms": statistics.median(run[f"{phase}_ms"] for run in runs) for phase in PHASES}
+    summary["total_ms"] = statistics.median(sum(run[f"{phase}_ms"] for phase in PHASES) for run in runs)
+    summary["rss_mb"] = {
+        phase: statistics.median(run["rss_mb"][phase] for run in runs)
+        for phase in ["interpreter"] + PHASES
+    }
+    summary["modules"] = last["modules"]
+    summary["eager"] = sorted({name for run in runs for name in run["eager"]})
+    return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> bool:
+    '''
+    Prints each phase's change from the baseline run. Returns False if any
+    phase's time, or the final RSS, grew by more than tolerance.
+    '''
+    passed = True
+    print(f"\n  {'vs baseline':<12} {'change':>9}")
+    rows = [(f"{phase} ms", summary[f"{phase}_ms"], baseline["startup"][f"{phase}_ms"]) for phase in PHASES]
+    rows.append(("RSS MB", summary["rss_mb"]["startup"], baseline["startup"]["rss_mb"]["startup"]))
+    for name, now, before in rows:
+        change = now / before - 1 if before else 0.0
+        regressed = change > tolerance
+        passed = passed and not regressed
+        print(f"  {name:<12} {change:>+9.1%}{'  REGRESSED' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time and memory of the bookshelf API process.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to start; medians are reported")
+    parser.add_argument("--max-import-ms", type=float, default=IMPORT_BUDGET_MS, help="budget for importing server")
+    parser.add_argument("--max-rss-mb", type=float, default=RSS_BUDGET_MB, help="budget for RSS after startup()")
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for _ in range(args.runs):
+            runs.append(json.loads(run_once(scratch).stdout.strip().splitlines()[-1]))
+        importtime = run_once(scratch, importtime=True).stderr if args.top else ""
+    summary = summarize(runs)
+
+    print(f"  {'phase':<12} {'ms':>9} {'RSS MB':>9}")
+    print(f"  {'interpreter':<12} {'':>9} {summary['rss_mb']['interpreter']:>9.1f}")
+    for phase in PHASES:
+        print(f"  {phase:<12} {summary[f'{phase}_ms']:>9.1f} {summary['rss_mb'][phase]:>9.1f}")
+    print(f"  {'total':<12} {summary['total_ms']:>9.1f}")
+    print(f"{summary['modules']} modules loaded after startup")
+    if args.top:
+        print(f"\n  {'slowest imports':<32} {'ms':>9}")
+        for milliseconds, name in slowest_imports(importtime, args.top):
+            print(f"  {name:<32} {milliseconds:>9.1f}")
+
+    passed = True
+    if summary["eager"]:
+        print(f"Loaded on import, should be lazy: {', '.join(summary['eager'])}")
+        passed = False
+    if summary["import_ms"] > args.max_import_ms:
+        print(f"Import took {summary['import_ms']:.0f}ms, over the {args.max_import_ms:.0f}ms budget")
+        passed = False
+    if summary["rss_mb"]["startup"] > args.max_rss_mb:
+        print(f"RSS after startup is {summary['rss_mb']['startup']:.1f}MB, over the {args.max_rss_mb:.0f}MB budget")
+        passed = False
+
+    report = {
+        "created_at": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"runs": args.runs},
+        "startup": summary,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+    if baseline is not None and not compare(summary, baseline, args.tolerance):
+        passed = False
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
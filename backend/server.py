@@ -1,31 +1,92 @@
 from typing import Dict, Union
-from fastapi import FastAPI, UploadFile, HTTPException, Depends 
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, UploadFile, HTTPException, Depends, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import FileResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
 import os
-from magic import from_file # This uses libmagic at the moment, but
-# I want to make it use something else for less dependency
-import shutil
+import json
+import asyncio
+import zipfile
+from starlette.concurrency import run_in_threadpool
 import librarytools
+import jobs
+import bulkimport
+import uploads
+import pages
+from librarycache import libraryCache
+from streaming import file_response
+from database import db
+import migrations
+import metrics
+from logconfig import configure_logging
 from auth import router as auth_router
 from auth import verify_refresh_token, get_current_userID
+import auth
+from passwords import hashingPool
 
-app = FastAPI()
+router = APIRouter()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Periodic tasks started by startup() and cancelled by shutdown()
+backgroundTasks: List[asyncio.Task] = []
 
-app.mount("/books", StaticFiles(directory="books"), name="books")
-app.mount("/thumbnails", StaticFiles(directory="thumbnails"), name="thumbnails")
+async def startup():
+    '''
+    Brings the process up: applies migrations, then starts the worker
+    pools and periodic tasks. Importing this module starts nothing.
+    '''
+    migrations.migrate()
+    auth.start_token_maintenance()
+    jobs.start()
+    bulkimport.start()
+    hashingPool.start()
+    pages.start()
+    backgroundTasks.extend([
+        asyncio.create_task(auth.purge_refresh_tokens_periodically()),
+        asyncio.create_task(jobs.backfill_metadata()),
+        asyncio.create_task(jobs.sweep_deleted_files()),
+    ])
+
+async def shutdown():
+    '''
+    Cancels the periodic tasks and stops everything startup() started, in reverse order.
+    '''
+    for task in reversed(backgroundTasks):
+        task.cancel()
+    backgroundTasks.clear()
+    pages.stop()
+    hashingPool.stop()
+    bulkimport.stop()
+    jobs.stop()
+    db.close()
 
-app.include_router(auth_router, prefix='/auth')
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+def create_app() -> FastAPI:
+    '''
+    Builds the API application. Run it with:
+        uvicorn server:create_app --factory
+    '''
+    configure_logging()
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(auth_router, prefix='/auth')
+    app.include_router(router)
+    return app
 
 allowed_extensions = ['pdf', 'epub', 'zip']
 
@@ -39,17 +100,37 @@ class BookData(BaseModel):
     author: Optional[str] = None
     file_type: str
     user_id: int
+    content_hash: Optional[str] = None
+
+class BookMetadata(BaseModel):
+    id: str
+    title: str
+    author: Optional[str] = None
+    file_type: str
+    added_at: Optional[int] = None
+    page_count: Optional[int] = None
+    byte_size: Optional[int] = None
+    language: Optional[str] = None
+    published: Optional[str] = None
+
+class BatchDelete(BaseModel):
+    book_ids: List[str] = Field(min_length=1, max_length=librarytools.DELETE_BATCH_MAX)
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
 
 class BookUploadResponse(BaseModel):
     bookData: BookData
+    thumbnailStatus: str
     message: str
 
-@app.get('/')
+@router.get('/')
 def main():
     return {"message": "Backend is Running!"}
 
 
-@app.post("/upload")
+@router.post("/upload")
 async def upload(
     file: UploadFile,
     current_user = Depends(get_current_userID)
@@ -61,85 +142,458 @@ async def upload(
     if not any(ext in file.content_type.lower() for ext in allowed_extensions):
         raise HTTPException(status_code=400, detail="Invalid file type.")
 
-    # More thorough file-type check
-    sample = await file.read()
-    await file.seek(0)  # Reset file pointer after reading
-    file_extension = librarytools.file_type_check(sample[:2048])
-
     # Generate Book Data
     bookData = {
         "id": librarytools.generate_unique_id(),
         "title": file.filename,
         "author": None,
-        "file_type": file_extension,
         "user_id": current_user.user_id
     }
 
-    # Generate a Thumbnail
+    # Stream the book to disk; the thorough file-type check runs on the first chunk
+    temp_location, file_extension, content_hash = await run_in_threadpool(
+        librarytools.store_book_stream, file.file
+    )
+    bookData["file_type"] = file_extension
+    bookData["content_hash"] = content_hash
+
+    # Storing the blob and queueing its jobs are database writes
+    return await run_in_threadpool(register_upload, bookData, temp_location)
+
+def register_upload(bookData: Dict, temp_location: str) -> BookUploadResponse:
+    '''
+    Registers an uploaded file, already hashed and type-checked, and queues
+    its background jobs. Identical content that is already stored is reused.
+    '''
+    content_hash, file_extension = bookData["content_hash"], bookData["file_type"]
     try:
-        thumbnailPath = librarytools.generate_thumbnail(sample, bookData)
+        isNewBlob = librarytools.store_book_blob(bookData, temp_location)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Thumbnail creation failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {e}")
 
-    # Upload the book
-    try:
-        os.makedirs("./books", exist_ok=True)
-        file_location = f"./books/{bookData['id']}.{file_extension}"
-        file.file.seek(0)
-        with open(file_location, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    if isNewBlob:
+        # Thumbnails are rendered in the background worker pool
+        file_location = librarytools.blob_location(content_hash, file_extension)
+        thumbnailStatus = jobs.submit(bookData["id"], "thumbnail", file_location)
+        jobs.submit(bookData["id"], "text", file_location)
+    else:
+        thumbnailReady = os.path.exists(librarytools.locate(librarytools.thumbnail_location(content_hash)))
+        thumbnailStatus = jobs.DONE if thumbnailReady else jobs.PENDING
+    # Author, page count and the rest are read from the file in the background
+    jobs.submit(bookData["id"], "metadata", librarytools.blob_location(content_hash, file_extension))
 
-        librarytools.create_library_entry(bookData)
+    return BookUploadResponse(
+        bookData=BookData(**bookData),
+        thumbnailStatus=thumbnailStatus,
+        message="File uploaded successfully!"
+    )
 
-        response_data = BookUploadResponse(
-            bookData=BookData(**bookData),
-            message="File uploaded successfully!"
-        )
-        return response_data
+@router.post('/uploads')
+def create_upload(data: UploadSessionRequest, current_user = Depends(get_current_userID)) -> Dict:
+    '''
+    Start a resumable upload. PUT the file's bytes to /uploads/{upload_id}?offset=N
+    in chunks of up to max_chunk_size, in parallel if you like, then POST
+    /uploads/{upload_id}/finalize. A dropped chunk is just sent again.
+    '''
+    return uploads.create_session(current_user.user_id, data.filename, data.size)
 
-    except Exception as e:
-        if os.path.exists(thumbnailPath):
-            os.remove(thumbnailPath)
-        if os.path.exists(file_location):
-            os.remove(file_location)
-        librarytools.delete_library_entry(bookData["id"])
-        raise HTTPException(status_code=500, detail=f"Error uploading file: {e}")
+@router.put('/uploads/{upload_id}')
+async def upload_chunk(
+    request: Request,
+    upload_id: str,
+    offset: int,
+    current_user = Depends(get_current_userID)
+) -> Dict:
+    '''
+    Write one chunk of a resumable upload at offset. Returns the ranges received so far.
+    '''
+    session = await run_in_threadpool(uploads.get_session, upload_id, current_user.user_id)
+    length = request.headers.get("content-length")
+    if length is None or not length.isdigit():
+        raise HTTPException(status_code=411, detail="Chunks need a Content-Length.")
+    return await uploads.receive_chunk(session, offset, int(length), request.stream())
+
+@router.get('/uploads/{upload_id}')
+def upload_status(upload_id: str, current_user = Depends(get_current_userID)) -> Dict:
+    '''
+    Report which byte ranges of a resumable upload have arrived, to resume after a dropped connection.
+    '''
+    return uploads.session_status(uploads.get_session(upload_id, current_user.user_id))
+
+@router.post('/uploads/{upload_id}/finalize')
+def finalize_upload(upload_id: str, current_user = Depends(get_current_userID)) -> BookUploadResponse:
+    '''
+    Finish a resumable upload once every byte has arrived and add the book to the library.
+    '''
+    session = uploads.get_session(upload_id, current_user.user_id)
+    temp_location, file_extension, content_hash = uploads.finalize_session(session)
+    bookData = {
+        "id": librarytools.generate_unique_id(),
+        "title": session["filename"],
+        "author": None,
+        "file_type": file_extension,
+        "user_id": current_user.user_id,
+        "content_hash": content_hash
+    }
+    return register_upload(bookData, temp_location)
+
+@router.delete('/uploads/{upload_id}')
+def cancel_upload(upload_id: str, current_user = Depends(get_current_userID)) -> Dict:
+    uploads.get_session(upload_id, current_user.user_id)
+    uploads.discard_session(upload_id)
+    return {"message": "Upload cancelled."}
+
+
+def save_import_archive(stream, location: str):
+    os.makedirs(bulkimport.IMPORT_DIRECTORY, exist_ok=True)
+    size = 0
+    with open(location, 'wb') as buffer:
+        while chunk := stream.read(librarytools.CHUNK_SIZE):
+            size += len(chunk)
+            if size > bulkimport.IMPORT_MAX_SIZE:
+                break
+            buffer.write(chunk)
+    if size > bulkimport.IMPORT_MAX_SIZE:
+        os.remove(location)
+        raise HTTPException(status_code=413, detail=f"Archives are limited to {bulkimport.IMPORT_MAX_SIZE} bytes.")
+    if not zipfile.is_zipfile(location):
+        os.remove(location)
+        raise HTTPException(status_code=400, detail="Invalid file type: expected a zip archive.")
+
+def queue_import(user_id: int, location: str) -> str:
+    import_id = bulkimport.importTable.add_import(user_id, location)
+    bulkimport.start_import(import_id, cleanup=True)
+    return import_id
+
+@router.post("/import")
+async def import_archive(
+    file: UploadFile,
+    current_user = Depends(get_current_userID)
+) -> Dict:
+    '''
+    Upload a zip archive of books and import them into the user's library
+    in the background. Poll /import/{import_id} for progress. Answers 429
+    while the import queue is full.
+    '''
+    if not bulkimport.has_capacity():
+        raise HTTPException(status_code=429, detail="Too many imports in progress, try again later.")
+    location = os.path.join(bulkimport.IMPORT_DIRECTORY, f"{librarytools.generate_unique_id()}.zip")
+    await run_in_threadpool(save_import_archive, file.file, location)
+    import_id = await run_in_threadpool(queue_import, current_user.user_id, location)
+    return {"import_id": import_id, "status": bulkimport.RUNNING}
+
+@router.get("/import/{import_id}")
+def import_status(import_id: str, current_user = Depends(get_current_userID)) -> Dict:
+    '''
+    Report the progress of a bulk import: entry counts by status and the first failures.
+    '''
+    report = bulkimport.import_progress(import_id)
+    if report is None or report["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Import not found.")
+    del report["source"]
+    return report
+
+def library_json(books: list, next_cursor: Optional[str]):
+    '''
+    Serializes a library page a few rows at a time; the pieces are joined
+    into the payload the library cache keeps.
+    '''
+    keys = ['id', 'title', 'author', 'file_type', 'added_at']
+    yield '{"books": ['
+    for start in range(0, len(books), 200):
+        batch = (json.dumps(dict(zip(keys, book))) for book in books[start:start + 200])
+        yield (', ' if start else '') + ', '.join(batch)
+    yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
 
+@router.get('/library/{user_id}')
+def library(
+    request: Request,
+    user_id : int,
+    sort: str = "title",
+    order: str = "asc",
+    limit: int = librarytools.LIBRARY_PAGE_SIZE,
+    cursor: Optional[str] = None
+) -> Response:
+    '''
+    Fetch one page of the selected user's library.
+    Pass the returned next_cursor back as ?cursor= to get the following page.
+    Pages are served from a per-user cache; send If-None-Match with the
+    last ETag to get a 304 when nothing has changed.
+    '''
+    def build() -> bytes:
+        bookList, next_cursor = librarytools.get_library_page(user_id, sort, order, limit, cursor)
+        return "".join(library_json(bookList, next_cursor)).encode()
 
+    page = libraryCache.get(user_id, (sort, order, limit, cursor), build)
+    headers = {"ETag": page.etag, "Cache-Control": "private, no-cache"}
+    if page.etag in request.headers.get("if-none-match", ""):
+        libraryCache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(page.payload, media_type="application/json", headers=headers)
 
-@app.get('/library/{user_id}')
-def library(user_id : int) -> Dict:
+@router.get('/library-cache')
+def library_cache_stats() -> Dict:
     '''
-    Fetch the selected user's library.
+    Report library cache size and hit rate.
     '''
-    bookList = librarytools.get_library_list(user_id)
-    return {"books": bookList}
+    return libraryCache.stats()
+
+def library_metrics() -> List[str]:
+    stats = libraryCache.stats()
+    return [
+        "# HELP bookshelf_library_cache_lookups_total Library page cache lookups, by result.",
+        "# TYPE bookshelf_library_cache_lookups_total counter",
+        f'bookshelf_library_cache_lookups_total{{result="hit"}} {stats["hits"]}',
+        f'bookshelf_library_cache_lookups_total{{result="miss"}} {stats["misses"]}',
+        "# HELP bookshelf_library_cache_bytes Size of the cached library pages.",
+        "# TYPE bookshelf_library_cache_bytes gauge",
+        f"bookshelf_library_cache_bytes {stats['bytes']}",
+        "# HELP bookshelf_jobs_unfinished Background jobs pending or running.",
+        "# TYPE bookshelf_jobs_unfinished gauge",
+        f"bookshelf_jobs_unfinished {jobs.jobTable.unfinished_count()}",
+    ]
+
+def token_cache_metrics() -> List[str]:
+    stats = auth.tokenCache.stats()
+    return [
+        "# HELP bookshelf_token_cache_lookups_total Access token cache lookups, by result.",
+        "# TYPE bookshelf_token_cache_lookups_total counter",
+        f'bookshelf_token_cache_lookups_total{{result="hit"}} {stats["hits"]}',
+        f'bookshelf_token_cache_lookups_total{{result="miss"}} {stats["misses"]}',
+        "# HELP bookshelf_token_cache_entries Access tokens held in the cache.",
+        "# TYPE bookshelf_token_cache_entries gauge",
+        f"bookshelf_token_cache_entries {stats['entries']}",
+    ]
+
+metrics.COLLECTORS.append(library_metrics)
+metrics.COLLECTORS.append(token_cache_metrics)
+
+@router.get('/metrics')
+def prometheus_metrics() -> Response:
+    '''
+    Request latencies, library stage and SQLite timings, cache hit counts and job counts in the Prometheus text format.
+    '''
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.get('/search')
+def search(
+    q: str,
+    limit: int = 20,
+    snippets: bool = True,
+    current_user = Depends(get_current_userID)
+) -> Dict:
+    '''
+    Full-text search over the current user's books (title, author and body text).
+    '''
+    return {"results": librarytools.search_library(current_user.user_id, q, limit, snippets)}
 
 # Unused endpoint, remove soon.
-@app.get('/books')
+@router.get('/books')
 def books() -> Dict:
-    books = os.listdir('./books')
-    book_types = [from_file(f"./books/{book}", mime=True) for book in books]
+    paths = [os.path.join(root, name) for root, _, names in os.walk('./books') for name in names if not name.startswith('.')]
+    books = [os.path.basename(path) for path in paths]
+    from magic import from_file
+    book_types = [from_file(path, mime=True) for path in paths]
     bookAndType = zip(books, book_types)
     return {"books": bookAndType}
 
-@app.delete('/delete/{book_id}')
-def delete_book(book_id: str) -> Dict:
+def book_response(request: Request, book: Dict) -> Response:
+    '''
+    Stream a stored book with Range and conditional GET support. The ETag
+    is the content hash, so it stays valid for as long as the book exists.
+    '''
+    name = librarytools.storage_name(book)
+    path = librarytools.locate(librarytools.blob_location(name, book["file_type"]))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Book file not found.")
+    if book.get("content_hash"):
+        etag = f'"{book["content_hash"]}"'
+    else:
+        stat = os.stat(path)
+        etag = f'"{book["id"]}-{int(stat.st_mtime)}-{stat.st_size}"'
+    media_type = librarytools.MEDIA_TYPES.get(book["file_type"], "application/octet-stream")
+    return file_response(request, path, etag, media_type)
+
+@router.api_route('/stream/{book_id}', methods=["GET", "HEAD"])
+def stream_book(request: Request, book_id: str, current_user = Depends(get_current_userID)) -> Response:
+    '''
+    Stream the original file of one of the current user's books, for
+    downloads, external readers and formats /pages doesn't render (the web
+    reader uses /pages). Supports single and multi-range requests,
+    If-None-Match / If-Modified-Since / If-Range and long-lived caching.
+    '''
+    book = librarytools.get_book(book_id)
+    if not book or book["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    return book_response(request, book)
+
+@router.api_route('/books/{file_name}', methods=["GET", "HEAD"])
+def book_file(request: Request, file_name: str, current_user = Depends(get_current_userID)) -> Response:
+    '''
+    Serve one of the current user's books by id ("<id>.<ext>"), resolved to
+    its stored blob. Kept for older clients; new ones use /stream.
+    '''
+    book = librarytools.get_book(os.path.splitext(file_name)[0])
+    if not book or book["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    return book_response(request, book)
+
+PRIVATE_IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def thumbnail_response(request: Request, book_id: str, size: str, user_id: int) -> Response:
+    '''
+    Serve a thumbnail rendition of one of the user's books. Named sizes in
+    WebP are served as rendered; other widths, and AVIF for clients that
+    accept it, are built on demand into an LRU disk cache. Thumbnails are
+    named by content hash, so they never change and can be cached forever,
+    but only by the browser, since they need the user's token.
+    '''
+    book = librarytools.get_book(book_id)
+    if not book or book["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    name = librarytools.storage_name(book)
+    format = "avif" if "image/avif" in request.headers.get("accept", "") else "webp"
+
+    if size in librarytools.THUMBNAIL_SIZES:
+        width = librarytools.THUMBNAIL_SIZES[size]
+    elif size.isdigit():
+        width = max(librarytools.THUMBNAIL_MIN_WIDTH, min(int(size), librarytools.THUMBNAIL_SIZES["large"]))
+    else:
+        raise HTTPException(status_code=400, detail=f"Invalid thumbnail size: {size}")
+
+    etag = f'"{name}-{width}.{format}"'
+    headers = {"ETag": etag, "Cache-Control": PRIVATE_IMMUTABLE_CACHE_CONTROL, "Vary": "Accept"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    named = [key for key, value in librarytools.THUMBNAIL_SIZES.items() if value == width]
+    path = librarytools.locate(librarytools.thumbnail_location(name, named[0])) if named and format == "webp" else None
+    if path is None or not os.path.exists(path):
+        source = librarytools.thumbnail_source(name)
+        if source is None:
+            raise HTTPException(status_code=404, detail="Thumbnail not available.")
+        path = librarytools.thumbnailCache.get_or_create(
+            f"{name}-{width}.{format}",
+            lambda output: librarytools.render_thumbnail_variant(source, width, format, output)
+        )
+    return FileResponse(path, media_type=f"image/{format}", headers=headers)
+
+@router.get('/thumbnails/{book_id}/{size}')
+def thumbnail(request: Request, book_id: str, size: str, current_user = Depends(get_current_userID)) -> Response:
+    '''
+    Serve a book's thumbnail at a named size (small, medium, large) or a width in pixels.
+    '''
+    return thumbnail_response(request, book_id, size, current_user.user_id)
+
+@router.get('/thumbnails/{file_name}')
+def thumbnail_file(request: Request, file_name: str, current_user = Depends(get_current_userID)) -> Response:
+    '''
+    Older "<id>.jpg" thumbnail URLs; serves the medium rendition.
+    '''
+    return thumbnail_response(request, os.path.splitext(file_name)[0], "medium", current_user.user_id)
+
+@router.get('/pages/{book_id}/{page}')
+def book_page(
+    request: Request,
+    book_id: str,
+    page: int,
+    width: int = 800,
+    current_user = Depends(get_current_userID)
+) -> Response:
+    '''
+    Serve one page of the current user's book as a WebP image, rendered on
+    first request. The width is rounded up to a step so similar screens share
+    renders. The next few pages are rendered in the background.
+    '''
+    book = librarytools.get_book(book_id)
+    if not book or book["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    if page < 1 or (book.get("page_count") and page > book["page_count"]):
+        raise HTTPException(status_code=404, detail="Page not found.")
+    name = librarytools.storage_name(book)
+    width = pages.page_width(width)
+
+    etag = f'"{pages.page_key(name, page, width)}"'
+    headers = {"ETag": etag, "Cache-Control": PRIVATE_IMMUTABLE_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    path = librarytools.locate(librarytools.blob_location(name, book["file_type"]))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Book file not found.")
+    try:
+        output = pages.render_page(name, path, page, width)
+    except NotImplementedError:
+        raise HTTPException(status_code=415, detail=f"Page rendering is not supported for {book['file_type']} files.")
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Page not found.")
+    pages.prefetch(name, path, page, width, book.get("page_count"))
+    return FileResponse(output, media_type="image/webp", headers=headers)
+
+@router.get('/jobs/{book_id}')
+def job_status(book_id: str, current_user = Depends(get_current_userID)) -> Dict:
+    '''
+    Report the background jobs (thumbnail rendering, ...) for one of the current user's books.
+    '''
+    book = librarytools.get_book(book_id)
+    if not book or book["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    return {"jobs": jobs.status(book_id)}
+
+@router.get('/metadata/{book_id}')
+def book_metadata(book_id: str, current_user = Depends(get_current_userID)) -> BookMetadata:
+    '''
+    Fetch a book's metadata, including what the background metadata job read from the file.
+    '''
+    book = librarytools.get_book(book_id)
+    if not book or book["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    return BookMetadata(**book)
+
+@router.delete('/delete/{book_id}')
+def delete_book(book_id: str, background_tasks: BackgroundTasks) -> Dict:
     deleteBookEntry = librarytools.delete_library_entry(book_id)
     if not deleteBookEntry:
         return {"message": "Error: Book entry could not be removed"}
-    deleteBookFile = librarytools.delete_library_file(book_id)
-    if not deleteBookFile:
-        return {"message": "Error: Book entry could not be removed"}
+    # The files are removed after the response is sent
+    background_tasks.add_task(librarytools.sweep_tombstones)
     return {"message": "Success, book entry and files removed."}
 
-@app.put('/edit/{book_id}')
+@router.post('/delete')
+def delete_books(
+    data: BatchDelete,
+    background_tasks: BackgroundTasks,
+    current_user = Depends(get_current_userID)
+) -> Dict:
+    '''
+    Delete several of the current user's books in one transaction. Ids that
+    don't exist or belong to someone else are reported as not deleted.
+    '''
+    deleted = librarytools.delete_library_entries(data.book_ids, current_user.user_id)
+    if deleted:
+        background_tasks.add_task(librarytools.sweep_tombstones)
+    deletedIds = set(deleted)
+    return {
+        "deleted": deleted,
+        "not_deleted": [book_id for book_id in data.book_ids if book_id not in deletedIds],
+    }
+
+@router.put('/edit/{book_id}')
 def edit_book_metadata(book_id: str, data: BookMetadataUpdate):
     # Check if at least one field is provided
     if data.title is None and data.author is None:
         raise HTTPException(status_code=400, detail="Error: At least one field (title or author) must be provided.")
     return librarytools.edit_library_entry(book_id, data.dict(exclude_unset=True))
 
-@app.get("/protected")
+@router.get("/protected")
 def protected_route(current_user: dict = Depends(verify_refresh_token)):
-    return {"message": f"Welcome {current_user['username']}."}
\ No newline at end of file
+    return {"message": f"Welcome {current_user['username']}."}
+
+
+def __getattr__(name: str):
+    # Keeps "uvicorn server:app" and "fastapi dev server.py" working; the app
+    # is only built when something asks for it
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
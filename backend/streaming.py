@@ -0,0 +1,219 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Tuple
+import os
+import secrets
+import anyio
+from fastapi import Request, Response
+
+# Book files are served straight from disk, with Range requests (including
+# multi-range) answered with 206/multipart responses, to clients that want
+# the original file: downloads, external readers, and formats /pages does
+# not render.
+#
+# Which path the bytes take depends on the deployment:
+# - Behind nginx, Apache or lighttpd, set BOOK_SENDFILE_HEADER and the app
+#   only checks access and answers 304s; the proxy sends the file with
+#   sendfile, ranges included. This is the zero-copy path for uvicorn,
+#   which offers no ASGI extension for it.
+# - Servers offering http.response.zerocopysend get every range sent with
+#   sendfile, and servers offering http.response.pathsend get whole files.
+# - Otherwise (plain uvicorn) the file is read in CHUNK_SIZE pieces off the
+#   event loop, which costs a copy through Python per chunk.
+
+CHUNK_SIZE = 1024 * 1024
+MAX_RANGES = 64
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+PATHSEND_EXTENSION = "http.response.pathsend"
+
+# "X-Accel-Redirect" (nginx) or "X-Sendfile" (Apache, lighttpd); empty serves files from the app.
+# nginx is sent BOOK_SENDFILE_PREFIX plus the path below ./books, which should be an internal
+# location aliased to the books directory; the others are sent the absolute path.
+BOOK_SENDFILE_HEADER = os.environ.get("BOOK_SENDFILE_HEADER", "")
+BOOK_SENDFILE_PREFIX = os.environ.get("BOOK_SENDFILE_PREFIX", "/protected-books/")
+BOOKS_ROOT = os.path.abspath('./books')
+
+# Book content never changes for a given id, so clients may keep it forever.
+# It is private because books are only served to their owner.
+BOOK_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def parse_range(header: str, size: int) -> List[Tuple[int, int]] | None:
+    '''
+    Parses a "bytes=" Range header into sorted, merged (start, end) pairs,
+    end inclusive. Returns None if the header should be ignored (malformed,
+    or too many ranges) and an empty list if no range is satisfiable.
+    '''
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        start_text, sep, end_text = part.strip().partition("-")
+        if not sep:
+            return None
+        if not start_text:
+            # Suffix range: the last N bytes
+            if not end_text.isdigit():
+                return None
+            length = int(end_text)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        if not start_text.isdigit() or (end_text and not end_text.isdigit()):
+            return None
+        start = int(start_text)
+        if end_text and int(end_text) < start:
+            return None
+        if start < size:
+            end = int(end_text) if end_text else size - 1
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(Response):
+    '''
+    Sends a file, or byte ranges of it, without loading it into memory.
+    '''
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        ranges: List[Tuple[int, int]] | None,
+        media_type: str,
+        headers: dict,
+        send_body: bool = True,
+    ):
+        self.path = path
+        self.send_body = send_body
+        # Each segment is (bytes to send before the file data, offset, count)
+        self.segments: List[Tuple[bytes, int, int]] = []
+        trailer = b""
+
+        if not ranges:
+            status_code = 200
+            self.segments.append((b"", 0, size))
+        elif len(ranges) == 1:
+            status_code = 206
+            start, end = ranges[0]
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            self.segments.append((b"", start, end - start + 1))
+        else:
+            status_code = 206
+            boundary = secrets.token_hex(16)
+            for index, (start, end) in enumerate(ranges):
+                preamble = (
+                    ("\r\n" if index else "") + f"--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode()
+                self.segments.append((preamble, start, end - start + 1))
+            trailer = f"\r\n--{boundary}--\r\n".encode()
+            media_type = f"multipart/byteranges; boundary={boundary}"
+
+        self.trailer = trailer
+        length = sum(len(preamble) + count for preamble, _, count in self.segments) + len(trailer)
+        headers["Content-Length"] = str(length)
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions", {})
+        if PATHSEND_EXTENSION in extensions and len(self.segments) == 1 and self.status_code == 200:
+            await send({"type": PATHSEND_EXTENSION, "path": os.path.abspath(self.path)})
+            return
+        zerocopy = ZEROCOPY_EXTENSION in extensions
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            for preamble, offset, count in self.segments:
+                if preamble:
+                    await send({"type": "http.response.body", "body": preamble, "more_body": True})
+                if zerocopy:
+                    await send({"type": ZEROCOPY_EXTENSION, "file": file, "offset": offset, "count": count, "more_body": True})
+                    continue
+                while count > 0:
+                    chunk = await anyio.to_thread.run_sync(os.pread, file.fileno(), min(CHUNK_SIZE, count), offset)
+                    if not chunk:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    offset += len(chunk)
+                    count -= len(chunk)
+            await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+        finally:
+            await anyio.to_thread.run_sync(file.close)
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _range_applies(request: Request, etag: str, last_modified: str) -> bool:
+    # If-Range: only honour the Range header if the client's copy is current
+    if_range = request.headers.get("if-range")
+    return if_range is None or if_range in (etag, last_modified)
+
+
+def sendfile_target(path: str) -> str:
+    path = os.path.abspath(path)
+    if BOOK_SENDFILE_HEADER.lower() == "x-accel-redirect":
+        return BOOK_SENDFILE_PREFIX.rstrip("/") + "/" + os.path.relpath(path, BOOKS_ROOT)
+    return path
+
+
+def file_response(request: Request, path: str, etag: str, media_type: str,
+                  cache_control: str = BOOK_CACHE_CONTROL) -> Response:
+    '''
+    Builds the response for a GET or HEAD of a stored file, handling
+    conditional requests (If-None-Match, If-Modified-Since, If-Range) and
+    single or multiple byte ranges. With BOOK_SENDFILE_HEADER set, files
+    under ./books are handed to the reverse proxy once past the 304 check.
+    '''
+    stat = os.stat(path)
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if _not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    if BOOK_SENDFILE_HEADER and os.path.abspath(path).startswith(BOOKS_ROOT + os.sep):
+        # The proxy serves the body, its length and any ranges from the file itself
+        headers[BOOK_SENDFILE_HEADER] = sendfile_target(path)
+        return Response(headers=headers, media_type=media_type)
+
+    ranges = None
+    range_header = request.headers.get("range")
+    if range_header and _range_applies(request, etag, last_modified):
+        ranges = parse_range(range_header, stat.st_size)
+        if ranges == []:
+            headers["Content-Range"] = f"bytes */{stat.st_size}"
+            return Response(status_code=416, headers=headers)
+
+    return RangeFileResponse(
+        path, stat.st_size, ranges, media_type, headers,
+        send_body=request.method != "HEAD"
+    )
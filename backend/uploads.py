@@ -0,0 +1,354 @@
+from typing import AsyncIterator, Dict, List, Tuple
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+import librarytools
+from database import Database, db
+
+# Resumable uploads for large books. A client creates a session with the
+# file's size, PUTs chunks at any offset (in parallel and in any order),
+# can ask which byte ranges have arrived, and finalizes once they cover the
+# whole file. Chunks are written straight into a file preallocated in
+# ./books and are hashed as soon as they extend the contiguous run from
+# byte 0, so finalizing only hashes what is left. Received ranges are kept
+# in the database, so a session survives dropped connections and restarts;
+# only the running hash is per process, and it is rebuilt from the file
+# when missing.
+
+# Chunk size suggested to clients, and the largest chunk accepted
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get("UPLOAD_MAX_CHUNK_SIZE", 64 * 1024 * 1024))
+UPLOAD_MAX_SIZE = librarytools.UPLOAD_MAX_SIZE
+# Sessions with no chunk for this long are discarded, in seconds, along with
+# temp files of direct uploads and imports that were never moved into place
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+# Each session reserves its full size on disk, so a user may only hold this
+# many open sessions, reserving this many bytes between them
+UPLOAD_MAX_SESSIONS = int(os.environ.get("UPLOAD_MAX_SESSIONS", 4))
+UPLOAD_MAX_RESERVED = int(os.environ.get("UPLOAD_MAX_RESERVED", 2 * UPLOAD_MAX_SIZE))
+
+# Request bodies are buffered up to this much before each write
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+logger = logging.getLogger("bookshelf.uploads")
+
+
+class UploadTable:
+    def __init__(self, database: Database = db):
+        self.database = database
+
+    def add_session(self, user_id: int, filename: str, size: int) -> str:
+        '''
+        Records a new session, unless the user already holds
+        UPLOAD_MAX_SESSIONS (429) or it would take their reserved bytes
+        over UPLOAD_MAX_RESERVED (507).
+        '''
+        upload_id = str(uuid.uuid4())
+        now = int(time.time())
+        with self.database.transaction() as con:
+            sessions, reserved = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if sessions >= UPLOAD_MAX_SESSIONS:
+                raise HTTPException(status_code=429, detail=f"At most {UPLOAD_MAX_SESSIONS} uploads can be open at once.")
+            if reserved + size > UPLOAD_MAX_RESERVED:
+                raise HTTPException(status_code=507, detail=f"Open uploads may reserve at most {UPLOAD_MAX_RESERVED} bytes.")
+            con.execute(
+                "INSERT INTO upload_sessions (id, user_id, filename, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (upload_id, user_id, filename, size, now, now)
+            )
+        return upload_id
+
+    def get_session(self, upload_id: str) -> Dict | None:
+        keys = ['id', 'user_id', 'filename', 'size', 'created_at', 'updated_at']
+        row = self.database.connection().execute(
+            "SELECT id, user_id, filename, size, created_at, updated_at FROM upload_sessions WHERE id = ?", (upload_id,)
+        ).fetchone()
+        return dict(zip(keys, row)) if row else None
+
+    def add_range(self, upload_id: str, start: int, end: int):
+        with self.database.transaction() as con:
+            con.execute(
+                "INSERT OR IGNORE INTO upload_chunks (upload_id, range_start, range_end) VALUES (?, ?, ?)",
+                (upload_id, start, end)
+            )
+            con.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (int(time.time()), upload_id))
+
+    def ranges(self, upload_id: str) -> List[Tuple[int, int]]:
+        cursor = self.database.connection().execute(
+            "SELECT range_start, range_end FROM upload_chunks WHERE upload_id = ? ORDER BY range_start", (upload_id,)
+        )
+        return merge_ranges(cursor.fetchall())
+
+    def delete_session(self, upload_id: str):
+        with self.database.transaction() as con:
+            con.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+
+    def expired_sessions(self, before: int) -> List[str]:
+        cursor = self.database.connection().execute(
+            "SELECT id FROM upload_sessions WHERE updated_at < ?", (before,)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+uploadTable = UploadTable()
+
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    '''
+    Merges sorted, possibly overlapping or adjacent [start, end) ranges.
+    '''
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def part_location(upload_id: str) -> str:
+    # In ./books so finalizing can move it into place with a rename
+    return f'./books/.session-{upload_id}.part'
+
+
+# Running SHA-256 of each session's contiguous prefix: (hasher, bytes hashed)
+_hashes: Dict[str, Tuple["hashlib._Hash", int]] = {}
+_sessionLocks: Dict[str, threading.Lock] = {}
+_locksLock = threading.Lock()
+_finalizing = set()
+# Chunks being written, per session, so overlapping chunks can't both be written
+_writing: Dict[str, List[Tuple[int, int]]] = {}
+
+def _session_lock(upload_id: str) -> threading.Lock:
+    with _locksLock:
+        return _sessionLocks.setdefault(upload_id, threading.Lock())
+
+def _forget(upload_id: str):
+    with _locksLock:
+        _hashes.pop(upload_id, None)
+        _sessionLocks.pop(upload_id, None)
+        _finalizing.discard(upload_id)
+        _writing.pop(upload_id, None)
+
+
+def session_status(session: Dict) -> Dict:
+    received = uploadTable.ranges(session["id"])
+    return {
+        "upload_id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "max_chunk_size": UPLOAD_MAX_CHUNK_SIZE,
+        "received": [[start, end] for start, end in received],
+        "complete": received == [(0, session["size"])],
+    }
+
+def create_session(user_id: int, filename: str, size: int) -> Dict:
+    '''
+    Starts an upload of size bytes and preallocates its file.
+    '''
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive.")
+    if size > UPLOAD_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {UPLOAD_MAX_SIZE} bytes.")
+    upload_id = uploadTable.add_session(user_id, filename, size)
+    os.makedirs('./books', exist_ok=True)
+    fd = os.open(part_location(upload_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        # Reserving the space up front fails fast on a full disk and avoids fragmenting large files
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    except OSError as e:
+        discard_session(upload_id)
+        raise HTTPException(status_code=507, detail=f"Not enough space for the upload: {e}")
+    finally:
+        os.close(fd)
+    return session_status(uploadTable.get_session(upload_id))
+
+def get_session(upload_id: str, user_id: int) -> Dict:
+    session = uploadTable.get_session(upload_id)
+    if session is None or session["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    return session
+
+def discard_session(upload_id: str):
+    uploadTable.delete_session(upload_id)
+    if os.path.exists(part_location(upload_id)):
+        os.remove(part_location(upload_id))
+    _forget(upload_id)
+
+
+def _pwrite_all(fd: int, data: bytes, position: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, position)
+        view = view[written:]
+        position += written
+
+def reserve_range(upload_id: str, start: int, end: int) -> bool:
+    '''
+    Claims [start, end) for writing. Returns False if those bytes already
+    arrived, and refuses a chunk that overlaps received bytes or a chunk
+    still being written.
+    '''
+    with _session_lock(upload_id):
+        received = uploadTable.ranges(upload_id)
+        if any(first <= start and end <= last for first, last in received):
+            return False
+        with _locksLock:
+            writing = _writing.setdefault(upload_id, [])
+            if any(first < end and start < last for first, last in received + writing):
+                raise HTTPException(status_code=409, detail="Chunk overlaps bytes already received.")
+            writing.append((start, end))
+        return True
+
+def release_range(upload_id: str, start: int, end: int):
+    # Only takes the short-lived _locksLock, so it's safe on the event loop
+    with _locksLock:
+        writing = _writing.get(upload_id)
+        if writing and (start, end) in writing:
+            writing.remove((start, end))
+
+async def receive_chunk(session: Dict, offset: int, length: int, body: AsyncIterator[bytes]) -> Dict:
+    '''
+    Writes a chunk of length bytes at offset, streaming it from body. A chunk
+    is only recorded once all of it is on disk, so an interrupted chunk is
+    simply sent again. Received bytes never change: resending a chunk that
+    already arrived is a no-op, and a chunk straddling received and missing
+    bytes, or one being written by another request, is refused.
+    '''
+    upload_id, end = session["id"], offset + length
+    if offset < 0 or length <= 0 or end > session["size"]:
+        raise HTTPException(status_code=416, detail=f"Chunk {offset}-{end} is outside the upload's {session['size']} bytes.")
+    if length > UPLOAD_MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Chunks are limited to {UPLOAD_MAX_CHUNK_SIZE} bytes.")
+
+    if not await run_in_threadpool(reserve_range, upload_id, offset, end):
+        async for _ in body:
+            pass
+        return await run_in_threadpool(session_status, session)
+
+    try:
+        try:
+            fd = os.open(part_location(upload_id), os.O_WRONLY)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found.")
+        try:
+            position = offset
+            buffer = bytearray()
+            async for piece in body:
+                if position + len(buffer) + len(piece) > end:
+                    raise HTTPException(status_code=400, detail="Chunk is longer than its Content-Length.")
+                buffer += piece
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    await run_in_threadpool(_pwrite_all, fd, bytes(buffer), position)
+                    position += len(buffer)
+                    buffer = bytearray()
+            if buffer:
+                await run_in_threadpool(_pwrite_all, fd, bytes(buffer), position)
+                position += len(buffer)
+        finally:
+            os.close(fd)
+        if position != end:
+            raise HTTPException(status_code=400, detail="Chunk ended before its Content-Length.")
+        await run_in_threadpool(uploadTable.add_range, upload_id, offset, end)
+    finally:
+        release_range(upload_id, offset, end)
+
+    await run_in_threadpool(advance_hash, upload_id)
+    return await run_in_threadpool(session_status, session)
+
+def advance_hash(upload_id: str) -> Tuple["hashlib._Hash", int]:
+    '''
+    Hashes any newly contiguous bytes from the start of the upload. The
+    data was written moments ago, so it is read back from the page cache.
+    Returns the hasher and how many bytes it has seen.
+    '''
+    with _session_lock(upload_id):
+        hasher, hashed = _hashes.get(upload_id) or (hashlib.sha256(), 0)
+        received = uploadTable.ranges(upload_id)
+        prefix = received[0][1] if received and received[0][0] == 0 else 0
+        if prefix > hashed:
+            with open(part_location(upload_id), 'rb') as file:
+                file.seek(hashed)
+                while hashed < prefix:
+                    data = file.read(min(librarytools.CHUNK_SIZE, prefix - hashed))
+                    if not data:
+                        break
+                    hasher.update(data)
+                    hashed += len(data)
+        _hashes[upload_id] = (hasher, hashed)
+        return hasher, hashed
+
+def finalize_session(session: Dict) -> Tuple[str, str, str]:
+    '''
+    Checks a complete upload's type and finishes its hash, then closes the
+    session. Returns the file's location, extension and SHA-256, ready for
+    librarytools.store_book_blob to move into place.
+    '''
+    upload_id = session["id"]
+    with _locksLock:
+        if upload_id in _finalizing:
+            raise HTTPException(status_code=409, detail="Upload is already being finalized.")
+        _finalizing.add(upload_id)
+    try:
+        received = uploadTable.ranges(upload_id)
+        if received != [(0, session["size"])]:
+            raise HTTPException(status_code=409, detail="Upload is incomplete; check the received ranges.")
+        hasher, hashed = advance_hash(upload_id)
+        if hashed != session["size"]:
+            raise HTTPException(status_code=500, detail="Upload file is shorter than its size.")
+        with open(part_location(upload_id), 'rb') as file:
+            head = file.read(librarytools.SNIFF_SIZE)
+        try:
+            file_extension = librarytools.file_type_check(head)
+        except HTTPException:
+            discard_session(upload_id)
+            raise
+    except BaseException:
+        with _locksLock:
+            _finalizing.discard(upload_id)
+        raise
+    # The file stays behind for the caller to store; if that never happens
+    # the expiry sweep removes it
+    uploadTable.delete_session(upload_id)
+    _forget(upload_id)
+    return part_location(upload_id), file_extension, hasher.hexdigest()
+
+
+def expire_sessions(ttl: int = UPLOAD_SESSION_TTL) -> int:
+    '''
+    Discards sessions that have received nothing for ttl seconds, upload
+    files left without a session, and temp files from store_book_stream
+    not written to for ttl seconds (left by a crash mid-upload or
+    mid-import). Returns the number discarded.
+    '''
+    before = int(time.time()) - ttl
+    expired = uploadTable.expired_sessions(before)
+    for upload_id in expired:
+        discard_session(upload_id)
+    if os.path.isdir('./books'):
+        for entry in os.scandir('./books'):
+            if not entry.name.endswith('.part'):
+                continue
+            if entry.name.startswith('.session-'):
+                upload_id = entry.name[len('.session-'):-len('.part')]
+                if entry.stat().st_mtime < before and uploadTable.get_session(upload_id) is None:
+                    os.remove(entry.path)
+                    expired.append(upload_id)
+            elif entry.name.startswith('.upload-') and entry.stat().st_mtime < before:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                expired.append(entry.name)
+    if expired:
+        logger.info("Discarded expired uploads", extra={"uploads": len(expired)})
+    return len(expired)
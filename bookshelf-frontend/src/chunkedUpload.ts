@@ -0,0 +1,97 @@
+import { fetchAPI } from "./apiClient";
+
+// Files above this size go through the resumable /uploads API instead of a single POST /upload
+export const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const PARALLEL_CHUNKS = 4;
+const CHUNK_ATTEMPTS = 5;
+
+interface UploadSession {
+  upload_id: string;
+  size: number;
+  chunk_size: number;
+  received: [number, number][];
+  complete: boolean;
+}
+
+// Remembers the session for a file so an upload interrupted by a reload carries on
+function sessionKey(file: File): string {
+  return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function readJSON(response: Response) {
+  if (!response.ok) {
+    const errorData = await response.json().catch(() => ({}));
+    throw new Error(errorData.detail || `Upload failed (${response.status})`);
+  }
+  return response.json();
+}
+
+async function openSession(file: File): Promise<UploadSession> {
+  const saved = localStorage.getItem(sessionKey(file));
+  if (saved) {
+    const response = await fetchAPI(`uploads/${saved}`);
+    if (response.ok) return response.json();
+    localStorage.removeItem(sessionKey(file));
+  }
+  const session = await readJSON(await fetchAPI("uploads", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ filename: file.name, size: file.size }),
+  }));
+  localStorage.setItem(sessionKey(file), session.upload_id);
+  return session;
+}
+
+// Chunk offsets not yet covered by the received ranges
+function missingChunks(session: UploadSession): [number, number][] {
+  const chunks: [number, number][] = [];
+  let position = 0;
+  const gaps = [...session.received, [session.size, session.size]];
+  for (const [start, end] of gaps) {
+    for (let offset = position; offset < start; offset += session.chunk_size) {
+      chunks.push([offset, Math.min(offset + session.chunk_size, start)]);
+    }
+    position = Math.max(position, end);
+  }
+  return chunks;
+}
+
+async function sendChunk(file: File, uploadId: string, start: number, end: number) {
+  for (let attempt = 1; ; attempt++) {
+    try {
+      await readJSON(await fetchAPI(`uploads/${uploadId}?offset=${start}`, {
+        method: "PUT",
+        body: file.slice(start, end),
+      }));
+      return;
+    } catch (err) {
+      if (attempt >= CHUNK_ATTEMPTS) throw err;
+      await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+    }
+  }
+}
+
+/**
+ * Uploads a file in parallel chunks, resuming a previous attempt at the same file
+ * if there is one. Resolves to the /upload-style response once the book is added.
+ */
+export async function uploadInChunks(file: File, onProgress?: (fraction: number) => void) {
+  const session = await openSession(file);
+  const queue = missingChunks(session);
+  let sent = session.received.reduce((total, [start, end]) => total + end - start, 0);
+  onProgress?.(sent / file.size);
+
+  const worker = async () => {
+    for (let chunk = queue.shift(); chunk; chunk = queue.shift()) {
+      await sendChunk(file, session.upload_id, chunk[0], chunk[1]);
+      sent += chunk[1] - chunk[0];
+      onProgress?.(sent / file.size);
+    }
+  };
+  await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+  const response = await fetchAPI(`uploads/${session.upload_id}/finalize`, { method: "POST" });
+  // 409 means chunks are still missing; anything else ends the session
+  if (response.status !== 409) localStorage.removeItem(sessionKey(file));
+  return readJSON(response);
+}
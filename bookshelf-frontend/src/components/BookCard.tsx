@@ -1,6 +1,7 @@
 import type { Book } from '../types/book'
 import { Link } from 'react-router-dom'
-import { useState } from 'react'
+import { useEffect, useState } from 'react'
+import { fetchAPI } from '../apiClient'
 
 interface BookCardProps {
     book: Book;
@@ -11,6 +12,30 @@ interface BookCardProps {
 
 export default function BookCard({ book, onDelete, onEdit }: BookCardProps) {
     const [showMenu, setShowMenu] = useState(false);
+    const [thumbnailUrl, setThumbnailUrl] = useState<string>("/placeholder.png");
+
+    // Thumbnails need the access token, which an <img src> can't send, so
+    // fetch the one sized for the screen and show it from an object URL.
+    useEffect(() => {
+        let cancelled = false;
+        let objectUrl: string | null = null;
+        const size = (window.devicePixelRatio || 1) > 1 ? "medium" : "small";
+
+        fetchAPI(`thumbnails/${book.id}/${size}`)
+            .then(async (response) => {
+                if (!response.ok) throw new Error(`Failed to load thumbnail (${response.status})`);
+                const blob = await response.blob();
+                if (cancelled) return;
+                objectUrl = URL.createObjectURL(blob);
+                setThumbnailUrl(objectUrl);
+            })
+            .catch((err) => console.error(err));
+
+        return () => {
+            cancelled = true;
+            if (objectUrl) URL.revokeObjectURL(objectUrl);
+        };
+    }, [book.id]);
 
     const toggleMenu = (e: any) => {
         e.preventDefault();
@@ -32,7 +57,7 @@ export default function BookCard({ book, onDelete, onEdit }: BookCardProps) {
                 position: "relative",
             }}
         >
-        <img src={`http://localhost:8000/thumbnails/${book.id}.jpg`}
+        <img src={thumbnailUrl}
             alt={book.title}
             style={{
                   width: "100%",
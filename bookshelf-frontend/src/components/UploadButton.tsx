@@ -1,5 +1,6 @@
 import React, { useState } from "react";
 import { fetchAPI } from "../apiClient";
+import { CHUNKED_UPLOAD_THRESHOLD, uploadInChunks } from "../chunkedUpload";
 
 interface UploadButtonProps {
   onFileSelected?: (file: File) => void; // callback so parent can handle the file
@@ -7,6 +8,7 @@ interface UploadButtonProps {
 
 export default function UploadButton({ onFileSelected }: UploadButtonProps) {
   const [uploading, setUploading] = useState(false); // simple local state for UI
+  const [progress, setProgress] = useState<number | null>(null);
 
   const handleFileChange = async (e: React.ChangeEvent<HTMLInputElement>) => {
     const file = e.target.files?.[0];
@@ -15,20 +17,26 @@ export default function UploadButton({ onFileSelected }: UploadButtonProps) {
     setUploading(true);
   
     try {
-      const formData = new FormData();
-      formData.append("file", file);
+      let data;
+      if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        // Large files go up in resumable chunks; picking the same file again resumes
+        data = await uploadInChunks(file, setProgress);
+      } else {
+        const formData = new FormData();
+        formData.append("file", file);
   
-      const response = await fetchAPI("upload", {
-        method: "POST",
-        body: formData,
-      });
+        const response = await fetchAPI("upload", {
+          method: "POST",
+          body: formData,
+        });
   
-      if (!response.ok) {
-        const errorData = await response.json();
-        throw new Error(errorData.detail || "Upload failed");
-      }
+        if (!response.ok) {
+          const errorData = await response.json();
+          throw new Error(errorData.detail || "Upload failed");
+        }
   
-      const data = await response.json();
+        data = await response.json();
+      }
       console.log("Upload successful:", data);
   
   
@@ -41,6 +49,7 @@ export default function UploadButton({ onFileSelected }: UploadButtonProps) {
       window.location.reload();
     } finally {
       setUploading(false);
+      setProgress(null);
       e.currentTarget.value = "";
     }
   };
@@ -58,7 +67,9 @@ export default function UploadButton({ onFileSelected }: UploadButtonProps) {
         fontSize: 14,
       }}
     >
-      {uploading ? "Uploading..." : "Upload Book"}
+      {uploading
+        ? progress === null ? "Uploading..." : `Uploading... ${Math.floor(progress * 100)}%`
+        : "Upload Book"}
       <input
         type="file"
         accept=".pdf,.epub"
@@ -1,4 +1,4 @@
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import BookCard from "../components/BookCard";
 import UploadButton from "../components/UploadButton";
 import type { Book } from '../types/book'
@@ -9,16 +9,26 @@ import { getIDFromToken } from "../auth";
 export default function Library() {
   const [books, setBooks] = useState<any[]>([]);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [editingBook, setEditingBook] = useState<Book | null>(null);
+  const sentinel = useRef<HTMLDivElement | null>(null);
   const token = localStorage.getItem('access_token');
   const user_id = getIDFromToken(token);
 
+  const fetchPage = async (cursor: string | null) => {
+    const query: string = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+    const response = await fetch(`http://localhost:8000/library/${user_id}${query}`);
+    return response.json();
+  };
+
+  // Loads the first page only; later pages are fetched as the user scrolls.
   const fetchBooks = async () => {
     try {
       setLoading(true); // start loading
-      const response = await fetch(`http://localhost:8000/library/${user_id}`);
-      const data = await response.json();
+      const data = await fetchPage(null);
       setBooks(data.books || []);
+      setNextCursor(data.next_cursor ?? null);
     } catch (error) {
       console.error("Error fetching books:", error);
     } finally {
@@ -26,10 +36,34 @@ export default function Library() {
     }
   };
 
+  const loadMore = async () => {
+    if (!nextCursor || loadingMore) return;
+    try {
+      setLoadingMore(true);
+      const data = await fetchPage(nextCursor);
+      setBooks((previous) => previous.concat(data.books || []));
+      setNextCursor(data.next_cursor ?? null);
+    } catch (error) {
+      console.error("Error fetching more books:", error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   useEffect(() => {
     fetchBooks();
   }, []);
 
+  // Fetch the next page when the end of the list scrolls into view
+  useEffect(() => {
+    if (!sentinel.current || !nextCursor) return;
+    const observer = new IntersectionObserver((entries) => {
+      if (entries[0].isIntersecting) loadMore();
+    }, { rootMargin: "400px" });
+    observer.observe(sentinel.current);
+    return () => observer.disconnect();
+  }, [nextCursor, loadingMore]);
+
   const handleDelete = async (id : number) => {
     if (!window.confirm("Are you sure you want to delete this book?")) return;
 
@@ -84,6 +118,13 @@ export default function Library() {
           )}
         </div>
       )}
+      {!loading && nextCursor && (
+        <div ref={sentinel} style={{ textAlign: "center", margin: "1.5rem 0" }}>
+          <button onClick={loadMore} disabled={loadingMore}>
+            {loadingMore ? "Loading..." : "Load more"}
+          </button>
+        </div>
+      )}
       {editingBook && (
             <EditMetadataModal
                 book={editingBook}
@@ -1,37 +1,72 @@
 import { useState, useEffect } from "react"
 import { useParams } from "react-router-dom"
-import { Document, Page, pdfjs } from "react-pdf"
-import "react-pdf/dist/Page/AnnotationLayer.css"
-import "react-pdf/dist/Page/TextLayer.css"
+import { fetchAPI } from "../apiClient"
 
-// PDF.js worker
-pdfjs.GlobalWorkerOptions.workerSrc = new URL(
-  "pdfjs-dist/build/pdf.worker.min.mjs",
-  import.meta.url
-).toString()
+// Pages are rendered by the backend one at a time, so the first page shows
+// up without downloading the whole book; the server renders the next few
+// pages ahead while this one is read.
+const PAGE_WIDTH = 800
+
+function renderWidth(): number {
+  const cssWidth = Math.min(PAGE_WIDTH, window.innerWidth - 32)
+  return Math.round(cssWidth * (window.devicePixelRatio || 1))
+}
 
 export default function Reader() {
   const { bookId } = useParams<{ bookId: string }>()
-  const [fileUrl, setFileUrl] = useState<string | null>(null)
-  const [numPages, setNumPages] = useState<number>(0)
+  const [pageUrl, setPageUrl] = useState<string | null>(null)
+  const [numPages, setNumPages] = useState<number | null>(null)
   const [pageNumber, setPageNumber] = useState<number>(1)
   const [error, setError] = useState<string | null>(null)
 
   useEffect(() => {
     if (!bookId) return
+    setPageNumber(1)
+    setNumPages(null)
 
-    // Build URL to the file on your backend
-    const url = `http://localhost:8000/books/${bookId}.pdf`
-    setFileUrl(url)
+    // The page count comes from the metadata job and may not be known yet
+    fetchAPI(`metadata/${bookId}`)
+      .then((response) => (response.ok ? response.json() : null))
+      .then((metadata) => setNumPages(metadata?.page_count ?? null))
+      .catch((err) => console.error(err))
   }, [bookId])
 
-  const onDocumentLoadSuccess = ({ numPages }: { numPages: number }) => {
-    setNumPages(numPages)
-    setPageNumber(1)
-  }
+  useEffect(() => {
+    if (!bookId) return
+    let cancelled = false
+    let objectUrl: string | null = null
+
+    setError(null)
+    fetchAPI(`pages/${bookId}/${pageNumber}?width=${renderWidth()}`)
+      .then(async (response) => {
+        if (response.status === 404 && pageNumber > 1) {
+          // Past the last page of a book whose page count isn't known yet
+          if (!cancelled) {
+            setNumPages(pageNumber - 1)
+            setPageNumber(pageNumber - 1)
+          }
+          return
+        }
+        if (!response.ok) throw new Error(`Failed to load page (${response.status})`)
+        const blob = await response.blob()
+        if (cancelled) return
+        objectUrl = URL.createObjectURL(blob)
+        setPageUrl(objectUrl)
+      })
+      .catch((err) => {
+        console.error(err)
+        if (!cancelled) setError("Failed to load page.")
+      })
+
+    return () => {
+      cancelled = true
+      if (objectUrl) URL.revokeObjectURL(objectUrl)
+    }
+  }, [bookId, pageNumber])
 
-  const nextPage = () => setPageNumber((p) => Math.min(p + 1, numPages))
+  const nextPage = () => setPageNumber((p) => (numPages === null ? p + 1 : Math.min(p + 1, numPages)))
   const prevPage = () => setPageNumber((p) => Math.max(p - 1, 1))
+  const lastPage = numPages !== null && pageNumber >= numPages
 
   return (
     <div style={{ textAlign: "center", padding: "1rem" }}>
@@ -48,27 +83,22 @@ export default function Reader() {
           ← Previous
         </button>
         <span>
-          Page {pageNumber} of {numPages}
+          Page {pageNumber}{numPages !== null && ` of ${numPages}`}
         </span>
-        <button onClick={nextPage} disabled={pageNumber >= numPages}>
+        <button onClick={nextPage} disabled={lastPage}>
           Next →
         </button>
       </div>
-      {fileUrl ? (
+      {pageUrl ? (
         <div style={{ display: "inline-block", border: "1px solid #ccc" }}>
-          <Document
-            file={fileUrl}
-            onLoadSuccess={onDocumentLoadSuccess}
-            onLoadError={(err) => {
-              console.error(err)
-              setError("Failed to load PDF.")
-            }}
-          >
-            <Page pageNumber={pageNumber} width={800} />
-          </Document>
+          <img
+            src={pageUrl}
+            alt={`Page ${pageNumber}`}
+            style={{ display: "block", width: Math.min(PAGE_WIDTH, window.innerWidth - 32) }}
+          />
         </div>
       ) : (
-        <p>Loading PDF...</p>
+        <p>Loading page...</p>
       )}
 
       {error && (
@@ -90,9 +120,9 @@ export default function Reader() {
           ← Previous
         </button>
         <span>
-          Page {pageNumber} of {numPages}
+          Page {pageNumber}{numPages !== null && ` of ${numPages}`}
         </span>
-        <button onClick={nextPage} disabled={pageNumber >= numPages}>
+        <button onClick={nextPage} disabled={lastPage}>
           Next →
         </button>
       </div>